@@ -1,13 +1,45 @@
+import asyncio
+import contextlib
 import base64
+import bisect
+import binascii
+import csv
+import difflib
+import email.utils
+import fcntl
+import functools
+import gzip
 import hashlib
 import hmac
+import io
 import json
+import math
+import mimetypes
+import multiprocessing
 import os
+import queue
+import re
 import secrets
+import select
+import signal
+import socket
 import sqlite3
+import sys
+import tempfile
+import threading
 import time
+import traceback
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.client import parse_headers
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import parse_qs, quote, urlparse
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:  # необязательная зависимость, без неё доступен только xor
+    AESGCM = None
 
 DB_PATH = os.environ.get("DB_PATH", "/data/app.db")
 APP_SECRET = os.environ.get("APP_SECRET", "dev-secret")
@@ -16,6 +48,105 @@ FILES_ROOT = os.environ.get("FILES_ROOT", "/data/files")
 DEFAULT_ADMIN_EMAIL = os.environ.get("DEFAULT_ADMIN_EMAIL", "a.moskalev")
 DEFAULT_ADMIN_PASSWORD = os.environ.get("DEFAULT_ADMIN_PASSWORD", "120488")
 ADMIN_SEED_MARKER = os.path.join(os.path.dirname(DB_PATH) or ".", ".admin_seeded")
+# xor (прототип, по умолчанию) | aesgcm (нужен пакет cryptography).
+# Расшифровка определяет шифр по префиксу, поэтому старые записи читаются всегда.
+FIELD_CIPHER = os.environ.get("FIELD_CIPHER", "xor")
+# Недокачанные файлы лежат здесь и переносятся на место атомарным rename
+STAGING_DIR = os.path.join(FILES_ROOT, ".staging")
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(4 * 1024 ** 3)))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+UPLOAD_SESSIONS_DIR = os.path.join(STAGING_DIR, "sessions")
+# Дедупликация: файлы — жёсткие ссылки на блобы FILES_ROOT/.blobs/ab/cd/<sha256>
+FILES_DEDUP = os.environ.get("FILES_DEDUP", "0") == "1"
+BLOBS_DIR = os.path.join(FILES_ROOT, ".blobs")
+# Служебные каталоги: не видны в листинге и недоступны через API.
+# Абсолютные: FILES_ROOT может быть относительным (./files), а сравниваются нормализованные пути
+INTERNAL_DIRS = tuple(os.path.abspath(path) for path in (STAGING_DIR, BLOBS_DIR))
+# Незавершённые загрузки и временные файлы старше этого удаляются
+UPLOAD_SESSION_TTL = float(os.environ.get("UPLOAD_SESSION_TTL", str(24 * 3600)))
+UPLOAD_SWEEP_INTERVAL = float(os.environ.get("UPLOAD_SWEEP_INTERVAL", "3600"))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_CACHE_KIB = int(os.environ.get("DB_CACHE_KIB", "8192"))
+DB_MMAP_BYTES = int(os.environ.get("DB_MMAP_BYTES", str(64 * 1024 * 1024)))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", "256"))
+# Параметры scrypt для новых хешей; старые пересчитываются при следующем входе
+SCRYPT_N = int(os.environ.get("SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = int(os.environ.get("SCRYPT_R", "8"))
+SCRYPT_P = int(os.environ.get("SCRYPT_P", "1"))
+SCRYPT_DKLEN = int(os.environ.get("SCRYPT_DKLEN", "32"))
+# 0 — считать scrypt прямо в потоке запроса
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+HASH_QUEUE_LIMIT = int(os.environ.get("HASH_QUEUE_LIMIT", "32"))
+LOGIN_IP_BURST = int(os.environ.get("LOGIN_IP_BURST", "10"))
+LOGIN_IP_PER_MINUTE = float(os.environ.get("LOGIN_IP_PER_MINUTE", "10"))
+LOGIN_ACCOUNT_BURST = int(os.environ.get("LOGIN_ACCOUNT_BURST", "5"))
+LOGIN_ACCOUNT_PER_MINUTE = float(os.environ.get("LOGIN_ACCOUNT_PER_MINUTE", "5"))
+SESSION_SWEEP_INTERVAL = float(os.environ.get("SESSION_SWEEP_INTERVAL", "3600"))
+SESSION_SWEEP_BATCH = int(os.environ.get("SESSION_SWEEP_BATCH", "500"))
+SESSION_MAX_PER_USER = int(os.environ.get("SESSION_MAX_PER_USER", "20"))
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "6"))
+# Тела больше этого сжимаются и отправляются по частям, без полной сжатой копии в памяти
+COMPRESS_STREAM_BYTES = int(os.environ.get("COMPRESS_STREAM_BYTES", str(1024 * 1024)))
+COMPRESS_CHUNK_BYTES = 64 * 1024
+BLOG_CACHE_TTL = float(os.environ.get("BLOG_CACHE_TTL", "10"))
+BLOG_MAX_AGE = int(os.environ.get("BLOG_MAX_AGE", "60"))
+PAGE_MAX_LIMIT = int(os.environ.get("PAGE_MAX_LIMIT", "500"))
+# Страница списков заметок и паролей, если limit не указан; весь список — только limit=all
+PAGE_DEFAULT_LIMIT = int(os.environ.get("PAGE_DEFAULT_LIMIT", "100"))
+# Tombstones удалённых записей для /api/sync живут столько, потом сжимаются
+SYNC_TOMBSTONE_TTL = float(os.environ.get("SYNC_TOMBSTONE_TTL", str(30 * 24 * 3600)))
+SYNC_COMPACT_INTERVAL = float(os.environ.get("SYNC_COMPACT_INTERVAL", "3600"))
+# История заметок: полный снимок текста не реже чем через столько дельт; сколько версий хранить
+NOTE_SNAPSHOT_EVERY = int(os.environ.get("NOTE_SNAPSHOT_EVERY", "50"))
+NOTE_REVISIONS_KEEP = int(os.environ.get("NOTE_REVISIONS_KEEP", "500"))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "1024"))
+# В prefork у каждого процесса свой кэш, поэтому TTL держим коротким:
+# выход из сессии в другом процессе будет замечен не позже чем через TTL
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", "30"))
+# Листинги каталогов FILES_ROOT и суммарные размеры поддеревьев в памяти процесса
+DIR_CACHE_SIZE = int(os.environ.get("DIR_CACHE_SIZE", "256"))
+DIR_TOTALS_SIZE = int(os.environ.get("DIR_TOTALS_SIZE", "16384"))
+DIR_CACHE_TTL = float(os.environ.get("DIR_CACHE_TTL", "300"))
+# Bearer-токен для сборщика метрик; без него /api/metrics доступен только администратору
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+# single | threaded | prefork | asyncio
+SERVER_MODE = os.environ.get("SERVER_MODE", "threaded")
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "16"))
+SERVER_BACKLOG = int(os.environ.get("SERVER_BACKLOG", "64"))
+SERVER_PROCESSES = int(os.environ.get("SERVER_PROCESSES", "0")) or os.cpu_count() or 1
+ASYNC_IDLE_TIMEOUT = float(os.environ.get("ASYNC_IDLE_TIMEOUT", "75"))
+ASYNC_MAX_HEADER_BYTES = int(os.environ.get("ASYNC_MAX_HEADER_BYTES", str(64 * 1024)))
+# HTTP/1.1 keep-alive потоковых режимов: простой соединения и запросов на одно соединение
+KEEPALIVE_TIMEOUT = float(os.environ.get("KEEPALIVE_TIMEOUT", "15"))
+KEEPALIVE_MAX_REQUESTS = int(os.environ.get("KEEPALIVE_MAX_REQUESTS", "100"))
+# /api/events: пульс, сколько последних событий помнить для Last-Event-ID, очередь
+# подписчика (переполнил — отключается) и срок жизни потока, после которого клиент
+# переподключается и заново проходит проверку сессии
+EVENTS_HEARTBEAT = float(os.environ.get("EVENTS_HEARTBEAT", "15"))
+EVENTS_HISTORY = int(os.environ.get("EVENTS_HISTORY", "1024"))
+EVENTS_MAX_PENDING = int(os.environ.get("EVENTS_MAX_PENDING", "256"))
+EVENTS_MAX_AGE = float(os.environ.get("EVENTS_MAX_AGE", "600"))
+EVENTS_MAX_SUBSCRIBERS = int(os.environ.get("EVENTS_MAX_SUBSCRIBERS", "1000"))
+# В потоковых режимах поток событий занимает поток пула; в asyncio — только корутину
+EVENTS_MAX_THREADS = int(os.environ.get("EVENTS_MAX_THREADS", str(max(1, SERVER_WORKERS // 2))))
+# Лимит JSON-тела; у старой загрузки base64 свой, побольше
+JSON_MAX_BYTES = int(os.environ.get("JSON_MAX_BYTES", str(1024 * 1024)))
+LEGACY_UPLOAD_MAX_BYTES = int(os.environ.get("LEGACY_UPLOAD_MAX_BYTES", str(64 * 1024 * 1024)))
+# Пакетные изменения и импорт: операций в /api/batch, размер файла импорта
+BATCH_MAX_OPERATIONS = int(os.environ.get("BATCH_MAX_OPERATIONS", "1000"))
+# Тело пакета: 1000 операций с заметками в несколько КБ не укладываются в JSON_MAX_BYTES
+BATCH_MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", str(16 * 1024 * 1024)))
+IMPORT_MAX_BYTES = int(os.environ.get("IMPORT_MAX_BYTES", str(16 * 1024 * 1024)))
+# Сколько тела asyncio-движок читает в память до вызова маршрута; stream — маршрут читает сокет сам
+BODY_LIMITS = {
+    "json": JSON_MAX_BYTES,
+    "batch": BATCH_MAX_BYTES,
+    "import": IMPORT_MAX_BYTES,
+    "legacy_upload": LEGACY_UPLOAD_MAX_BYTES,
+    "stream": UPLOAD_MAX_BYTES,
+}
 
 
 def ensure_column(conn, table: str, column: str, definition: str):
@@ -24,10 +155,7 @@ def ensure_column(conn, table: str, column: str, definition: str):
         conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
 
 
-def ensure_db():
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    os.makedirs(FILES_ROOT, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+def migrate_base_schema(conn):
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS users (
@@ -84,12 +212,219 @@ def ensure_db():
         )
         """
     )
+    # Базы, созданные до появления user_version, могут быть без этих колонок
     ensure_column(conn, "users", "password_manager_url", "TEXT")
     ensure_column(conn, "users", "is_admin", "INTEGER NOT NULL DEFAULT 0")
     ensure_column(conn, "users", "nickname", "TEXT")
     ensure_column(conn, "notes", "published", "INTEGER NOT NULL DEFAULT 0")
     ensure_column(conn, "password_items", "url_enc", "TEXT")
 
+
+def migrate_session_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions(expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id, created_at)")
+
+
+def migrate_list_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notes_user_updated ON notes(user_id, updated_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_password_items_user_updated ON password_items(user_id, updated_at)")
+
+
+def migrate_blob_store(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS file_blobs (
+            path TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            FOREIGN KEY(hash) REFERENCES blobs(hash)
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_file_blobs_hash ON file_blobs(hash)")
+
+
+def create_search_index(conn) -> bool:
+    """FTS5-индекс по notes(title, content_md) и триггеры синхронизации.
+
+    False, если SQLite собран без FTS5: тогда поиск отвечает 501, а индекс
+    можно создать позже командой `python app.py rebuild-search`.
+    """
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5("
+            "title, content_md, content='notes', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        )
+    except sqlite3.OperationalError:
+        return False
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts(rowid, title, content_md) VALUES (new.id, new.title, new.content_md);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, title, content_md) VALUES ('delete', old.id, old.title, old.content_md);
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, content_md ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, title, content_md) VALUES ('delete', old.id, old.title, old.content_md);
+            INSERT INTO notes_fts(rowid, title, content_md) VALUES (new.id, new.title, new.content_md);
+        END
+        """
+    )
+    return True
+
+
+def migrate_search_index(conn):
+    if create_search_index(conn):
+        conn.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')")
+
+
+# Что отдаёт /api/sync: ключ ответа -> таблица
+SYNC_TABLES = {"notes": "notes", "passwords": "password_items"}
+
+
+def migrate_sync_log(conn):
+    """Сквозной счётчик изменений seq для заметок и паролей и tombstones удалений.
+
+    seq растёт на каждую вставку и изменение строки, удаление оставляет tombstone
+    со своим seq. Всё ведут триггеры, поэтому учитываются и пакеты, и импорт.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS sync_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    # compacted — наибольший seq удалённых при сжатии tombstones
+    conn.execute("INSERT OR IGNORE INTO sync_counters (name, value) VALUES ('seq', 0), ('compacted', 0)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_tombstones (
+            seq INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            deleted_at INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sync_tombstones_user_seq ON sync_tombstones(user_id, seq)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sync_tombstones_deleted ON sync_tombstones(deleted_at)")
+    seq = 0
+    for kind, table in SYNC_TABLES.items():
+        ensure_column(conn, table, "seq", "INTEGER NOT NULL DEFAULT 0")
+        # Уже существующим строкам — seq в порядке изменения
+        ids = [row[0] for row in conn.execute(f"SELECT id FROM {table} ORDER BY updated_at, id")]
+        conn.executemany(
+            f"UPDATE {table} SET seq = ? WHERE id = ?",
+            [(seq + number, item_id) for number, item_id in enumerate(ids, start=1)],
+        )
+        seq += len(ids)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_seq ON {table}(user_id, seq)")
+        next_seq = f"""
+            UPDATE sync_counters SET value = value + 1 WHERE name = 'seq';
+            UPDATE {table} SET seq = (SELECT value FROM sync_counters WHERE name = 'seq') WHERE id = new.id;
+        """
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_sync_insert AFTER INSERT ON {table} BEGIN {next_seq} END")
+        # WHEN: собственное UPDATE seq триггер повторно не запускает
+        conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_sync_update AFTER UPDATE ON {table} "
+            f"WHEN new.seq = old.seq BEGIN {next_seq} END"
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_sync_delete AFTER DELETE ON {table} BEGIN
+                UPDATE sync_counters SET value = value + 1 WHERE name = 'seq';
+                INSERT INTO sync_tombstones (seq, kind, item_id, user_id, deleted_at) VALUES (
+                    (SELECT value FROM sync_counters WHERE name = 'seq'), '{kind}', old.id, old.user_id,
+                    CAST(strftime('%s', 'now') AS INTEGER)
+                );
+            END
+            """
+        )
+    conn.execute("UPDATE sync_counters SET value = ? WHERE name = 'seq'", (seq,))
+
+
+def migrate_note_revisions(conn):
+    """История текста заметок. Версия заметки — её seq.
+
+    base_version IS NULL — в data полный текст (снимок), иначе JSON-правки
+    от текста base_version (см. apply_text_ops).
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS note_revisions (
+            note_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            base_version INTEGER,
+            data TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (note_id, version)
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_revisions_delete AFTER DELETE ON notes BEGIN
+            DELETE FROM note_revisions WHERE note_id = old.id;
+        END
+        """
+    )
+
+
+# Порядок важен: номер шага = индекс + 1, хранится в PRAGMA user_version.
+# Новые изменения схемы только добавляются в конец списка.
+MIGRATIONS = [
+    migrate_base_schema,
+    migrate_session_indexes,
+    migrate_list_indexes,
+    migrate_search_index,
+    migrate_blob_store,
+    migrate_sync_log,
+    migrate_note_revisions,
+]
+
+
+def schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_db(conn):
+    for version, step in enumerate(MIGRATIONS, start=1):
+        if schema_version(conn) >= version:
+            continue
+        # IMMEDIATE берёт блокировку записи до проверки версии,
+        # чтобы параллельно стартующие процессы не применили шаг дважды
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(conn) < version:
+                step(conn)
+                conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def ensure_db():
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    os.makedirs(FILES_ROOT, exist_ok=True)
+    os.makedirs(UPLOAD_SESSIONS_DIR, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH)
+    migrate_db(conn)
     seed_default_admin(conn)
     conn.commit()
     conn.close()
@@ -117,47 +452,596 @@ def seed_default_admin(conn):
         marker.write(str(int(time.time())))
 
 
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_PHASES = ("db", "crypto", "serialize")
+PROCESS_STARTED_AT = time.time()
+# Время фаз текущего запроса: {фаза: секунды}; вне запроса атрибута нет
+REQUEST_PHASES = threading.local()
+
+
+def add_phase_time(phase: str, elapsed: float):
+    phases = getattr(REQUEST_PHASES, "current", None)
+    if phases is not None:
+        phases[phase] += elapsed
+
+
+def timed_phase(phase: str):
+    """Декоратор: время вызова засчитывается в фазу текущего запроса.
+
+    Вложенные вызовы (decrypt_fields → decrypt_field) не считаются дважды.
+    """
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            phases = getattr(REQUEST_PHASES, "current", None)
+            if phases is None or REQUEST_PHASES.active:
+                return func(*args, **kwargs)
+            REQUEST_PHASES.active = True
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                phases[phase] += time.perf_counter() - started
+                REQUEST_PHASES.active = False
+
+        return wrapper
+
+    return decorate
+
+
+class Histogram:
+    __slots__ = ("counts", "total")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, value: float):
+        # le — «меньше или равно», поэтому bisect_left
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        self.total += value
+
+
+def metric_labels(**labels) -> str:
+    escaped = (
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """Счётчики и гистограммы по маршрутам в памяти процесса.
+
+    На запрос — пара словарных обновлений под блокировкой; текст Prometheus
+    собирается только при чтении /api/metrics. В prefork у каждого воркера свои значения.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.phases = {}
+        self.in_flight = {}
+
+    def start(self, key: tuple):
+        with self.lock:
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+
+    def finish(self, key: tuple, status: int, elapsed: float, phases: dict = None):
+        with self.lock:
+            self.in_flight[key] = self.in_flight.get(key, 1) - 1
+            counter = key + (status,)
+            self.requests[counter] = self.requests.get(counter, 0) + 1
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = Histogram()
+            histogram.observe(elapsed)
+            for phase, value in (phases or {}).items():
+                histogram = self.phases.get(key + (phase,))
+                if histogram is None:
+                    histogram = self.phases[key + (phase,)] = Histogram()
+                histogram.observe(value)
+
+    def summary(self) -> dict:
+        """Короткая сводка для /api/admin/stats: число запросов и среднее время по маршрутам."""
+        with self.lock:
+            return {
+                f"{method} {route}": {
+                    "count": sum(histogram.counts),
+                    "avg_ms": round(histogram.total / max(1, sum(histogram.counts)) * 1000, 3),
+                    "in_flight": self.in_flight.get((method, route), 0),
+                }
+                for (method, route), histogram in sorted(self.latency.items())
+            }
+
+    def render_histogram(self, lines: list, name: str, labels: dict, histogram: Histogram):
+        cumulative = 0
+        for bound, count in zip(METRICS_BUCKETS, histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{metric_labels(**labels, le=bound)} {cumulative}")
+        cumulative += histogram.counts[-1]
+        lines.append(f"{name}_bucket{metric_labels(**labels, le='+Inf')} {cumulative}")
+        lines.append(f"{name}_sum{metric_labels(**labels)} {histogram.total:.6f}")
+        lines.append(f"{name}_count{metric_labels(**labels)} {cumulative}")
+
+    def render(self, gauges: list) -> str:
+        """gauges — [(имя, тип, справка, [(labels, значение)])] из пулов и кэшей."""
+        with self.lock:
+            requests = sorted(self.requests.items())
+            latency = [(key, Histogram.__new__(Histogram)) for key in sorted(self.latency)]
+            for key, copy in latency:
+                copy.counts, copy.total = list(self.latency[key].counts), self.latency[key].total
+            phases = [(key, Histogram.__new__(Histogram)) for key in sorted(self.phases)]
+            for key, copy in phases:
+                copy.counts, copy.total = list(self.phases[key].counts), self.phases[key].total
+            in_flight = sorted(self.in_flight.items())
+        lines = [
+            "# HELP http_requests_total Requests by route and status.",
+            "# TYPE http_requests_total counter",
+        ]
+        for (method, route, status), count in requests:
+            lines.append(f"http_requests_total{metric_labels(method=method, route=route, status=status)} {count}")
+        lines += [
+            "# HELP http_request_duration_seconds Request latency by route.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (method, route), histogram in latency:
+            self.render_histogram(lines, "http_request_duration_seconds", {"method": method, "route": route}, histogram)
+        lines += [
+            "# HELP http_request_phase_seconds Time spent per request in db, crypto and serialize phases.",
+            "# TYPE http_request_phase_seconds histogram",
+        ]
+        for (method, route, phase), histogram in phases:
+            labels = {"method": method, "route": route, "phase": phase}
+            self.render_histogram(lines, "http_request_phase_seconds", labels, histogram)
+        lines += [
+            "# HELP http_requests_in_flight Requests currently being handled.",
+            "# TYPE http_requests_in_flight gauge",
+        ]
+        for (method, route), value in in_flight:
+            lines.append(f"http_requests_in_flight{metric_labels(method=method, route=route)} {value}")
+        for name, kind, help_text, samples in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{metric_labels(**labels) if labels else ''} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, у которого выборка строк тоже идёт в фазу db: sqlite3 шагает запрос лениво,
+    и основная работа SELECT со списками приходится на fetch, а не на execute.
+    """
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            add_phase_time("db", time.perf_counter() - started)
+
+    def fetchmany(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            add_phase_time("db", time.perf_counter() - started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            add_phase_time("db", time.perf_counter() - started)
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            add_phase_time("db", time.perf_counter() - started)
+
+
+class PooledConnection(sqlite3.Connection):
+    """Соединение из пула: close() возвращает его в пул, а не закрывает."""
+
+    def execute(self, *args):
+        # Connection.execute создаёт обычный курсор, поэтому курсор с таймингом — явно
+        started = time.perf_counter()
+        try:
+            return self.cursor(TimedCursor).execute(*args)
+        finally:
+            add_phase_time("db", time.perf_counter() - started)
+
+    def executemany(self, *args):
+        started = time.perf_counter()
+        try:
+            return self.cursor(TimedCursor).executemany(*args)
+        finally:
+            add_phase_time("db", time.perf_counter() - started)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            add_phase_time("db", time.perf_counter() - started)
+
+    def close(self):
+        DB_POOL.release(self)
+
+    def really_close(self):
+        sqlite3.Connection.close(self)
+
+
+class ConnectionPool:
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.created = 0
+        self.acquires = 0
+        self.in_use = 0
+
+    def connect(self) -> PooledConnection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+            factory=PooledConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        # WAL: читатели не ждут писателя; NORMAL в WAL не теряет целостность
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KIB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_BYTES}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        with self.lock:
+            self.created += 1
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        with self.lock:
+            if self.pid != os.getpid():
+                # После fork соединения родителя использовать нельзя
+                self.idle = []
+                self.pid = os.getpid()
+            self.acquires += 1
+            self.in_use += 1
+            if self.idle:
+                return self.idle.pop()
+        return self.connect()
+
+    def release(self, conn: PooledConnection):
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            if any(idle is conn for idle in self.idle):
+                return
+            self.in_use -= 1
+            if self.pid == os.getpid() and len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.really_close()
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.really_close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "idle": len(self.idle),
+                "in_use": self.in_use,
+                "created": self.created,
+                "acquires": self.acquires,
+            }
+
+
+DB_POOL = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+
+
 def get_conn():
-    ensure_db()
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return DB_POOL.acquire()
+
 
+SCRYPT_PARAMS = (SCRYPT_N, SCRYPT_R, SCRYPT_P, SCRYPT_DKLEN)
+# Хеши без префикса записаны до появления формата с параметрами
+LEGACY_SCRYPT_PARAMS = (2 ** 14, 8, 1, 32)
 
+
+def scrypt_hash(password: str, salt: bytes, params: tuple = SCRYPT_PARAMS) -> bytes:
+    n, r, p, dklen = params
+    # Запас памяти под n и r больше дефолтных 32 МиБ OpenSSL
+    maxmem = 129 * r * (n + p) + 1024 * 1024
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=dklen, maxmem=maxmem)
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """Считает scrypt в отдельных процессах, не занимая потоки сервера.
+
+    Очередь ограничена: при переполнении сразу HasherBusy, а не ожидание.
+    """
+
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(max(queue_limit, workers, 1))
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+        # Счётчики меняют потоки запросов; отдельный lock — не ждать создания пула в get_executor
+        self.counter_lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                # spawn: воркеры не наследуют потоки и соединения сервера
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                self.pid = os.getpid()
+            return self.executor
+
+    def run(self, password: str, salt: bytes, params: tuple = SCRYPT_PARAMS) -> bytes:
+        if self.workers <= 0:
+            return scrypt_hash(password, salt, params)
+        if not self.slots.acquire(blocking=False):
+            with self.counter_lock:
+                self.rejected += 1
+            raise HasherBusy()
+        with self.counter_lock:
+            self.in_flight += 1
+        try:
+            return self.get_executor().submit(scrypt_hash, password, salt, params).result()
+        finally:
+            with self.counter_lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def resize(self, workers: int):
+        """Новый размер пула; процессы создаются заново при следующем хешировании."""
+        self.shutdown()
+        self.workers = workers
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None and self.pid == os.getpid():
+                self.executor.shutdown()
+            self.executor = None
+
+
+PASSWORD_HASHER = PasswordHasher(HASH_WORKERS, HASH_QUEUE_LIMIT)
+
+
+@timed_phase("crypto")
 def hash_password(password: str) -> str:
+    """Формат: scrypt$n=16384,r=8,p=1,dklen=32$<base64 соль>$<base64 хеш>."""
     salt = secrets.token_bytes(16)
-    hashed = hashlib.scrypt(password.encode(), salt=salt, n=2 ** 14, r=8, p=1, dklen=32)
-    return base64.b64encode(salt + hashed).decode()
+    hashed = PASSWORD_HASHER.run(password, salt)
+    n, r, p, dklen = SCRYPT_PARAMS
+    return "$".join(
+        [
+            "scrypt",
+            f"n={n},r={r},p={p},dklen={dklen}",
+            base64.b64encode(salt).decode(),
+            base64.b64encode(hashed).decode(),
+        ]
+    )
 
 
+def parse_password_hash(stored: str):
+    """(params, salt, hash) из сохранённой строки; ValueError, если формат не распознан."""
+    if "$" not in stored:
+        data = base64.b64decode(stored.encode(), validate=True)
+        return LEGACY_SCRYPT_PARAMS, data[:16], data[16:]
+    algorithm, params_str, salt_b64, hash_b64 = stored.split("$")
+    if algorithm != "scrypt":
+        raise ValueError(f"unsupported algorithm: {algorithm}")
+    params = dict(item.split("=", 1) for item in params_str.split(","))
+    return (
+        (int(params["n"]), int(params["r"]), int(params["p"]), int(params["dklen"])),
+        base64.b64decode(salt_b64.encode(), validate=True),
+        base64.b64decode(hash_b64.encode(), validate=True),
+    )
+
+
+@timed_phase("crypto")
 def verify_password(password: str, stored: str) -> bool:
     try:
-        data = base64.b64decode(stored.encode())
-        salt, hashed = data[:16], data[16:]
-        new_hash = hashlib.scrypt(password.encode(), salt=salt, n=2 ** 14, r=8, p=1, dklen=32)
-        return hmac.compare_digest(hashed, new_hash)
-    except Exception:
+        params, salt, hashed = parse_password_hash(stored)
+    except (ValueError, KeyError):
         return False
+    return hmac.compare_digest(hashed, PASSWORD_HASHER.run(password, salt, params))
+
+
+def password_needs_rehash(stored: str) -> bool:
+    if "$" not in stored:
+        return True
+    try:
+        params, _, _ = parse_password_hash(stored)
+    except (ValueError, KeyError):
+        return True
+    return params != SCRYPT_PARAMS
+
+
+class RateLimiter:
+    """Token bucket на ключ (IP, email). Хранит не больше max_keys последних ключей."""
+
+    def __init__(self, burst: int, per_minute: float, max_keys: int = 10000):
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def retry_after(self, key: str, consume: bool = True) -> float:
+        """0 — запрос разрешён, иначе сколько секунд подождать."""
+        if self.burst <= 0:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                wait = 0
+                if consume:
+                    tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate if self.rate else 60
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return wait
+
+
+LOGIN_IP_LIMITER = RateLimiter(LOGIN_IP_BURST, LOGIN_IP_PER_MINUTE)
+# По аккаунту считаются только неудачные попытки
+LOGIN_ACCOUNT_LIMITER = RateLimiter(LOGIN_ACCOUNT_BURST, LOGIN_ACCOUNT_PER_MINUTE)
+
+
+class XorCipher:
+    """Примитивный XOR для прототипа (заменить на настоящую криптографию в продакшене).
+
+    Формат совместим с записями, сделанными до появления префиксов.
+    """
+
+    prefix = ""
+
+    def __init__(self, secret: str):
+        self.key = hashlib.sha256(secret.encode()).digest()
+        self.keystream = self.key * 128
+
+    def xor(self, data: bytes) -> bytes:
+        size = len(data)
+        stream = self.keystream if size <= len(self.keystream) else self.key * (size // len(self.key) + 1)
+        # Одна операция над целыми числами вместо цикла по байтам
+        mixed = int.from_bytes(data, "little") ^ int.from_bytes(stream[:size], "little")
+        return mixed.to_bytes(size, "little")
+
+    def encrypt(self, data: bytes) -> bytes:
+        return self.xor(data)
+
+    def decrypt(self, data: bytes) -> bytes:
+        return self.xor(data)
+
+    def decrypt_many(self, blobs: list) -> list:
+        # Каждое значение начинается с начала ключа: добиваем до кратной ключу длины,
+        # склеиваем и расшифровываем одним XOR
+        block = len(self.key)
+        joined = self.xor(b"".join(blob + b"\0" * (-len(blob) % block) for blob in blobs))
+        result = []
+        offset = 0
+        for blob in blobs:
+            result.append(joined[offset:offset + len(blob)])
+            offset += len(blob) + (-len(blob) % block)
+        return result
+
+
+class AesGcmCipher:
+    prefix = "v2:"
+
+    def __init__(self, secret: str):
+        key = hmac.new(secret.encode(), b"field-encryption-aes-gcm", hashlib.sha256).digest()
+        self.aead = AESGCM(key)
+
+    def encrypt(self, data: bytes) -> bytes:
+        nonce = secrets.token_bytes(12)
+        return nonce + self.aead.encrypt(nonce, data, None)
+
+    def decrypt(self, data: bytes) -> bytes:
+        return self.aead.decrypt(data[:12], data[12:], None)
+
+    def decrypt_many(self, blobs: list) -> list:
+        return [self.decrypt(blob) for blob in blobs]
+
+
+def make_field_ciphers(secret: str) -> dict:
+    ciphers = {"xor": XorCipher(secret)}
+    if AESGCM is not None:
+        ciphers["aesgcm"] = AesGcmCipher(secret)
+    if FIELD_CIPHER not in ciphers:
+        raise RuntimeError(f"FIELD_CIPHER={FIELD_CIPHER} is not available")
+    return ciphers
+
+
+# Ключи выводятся один раз при старте
+FIELD_CIPHERS = make_field_ciphers(APP_SECRET)
+PREFIXED_CIPHERS = [cipher for cipher in FIELD_CIPHERS.values() if cipher.prefix]
 
 
-def simple_encrypt(plaintext: str) -> str:
-    # Примитивный XOR-подход для прототипа (заменить на настоящую криптографию в продакшене)
-    key = hashlib.sha256(APP_SECRET.encode()).digest()
-    data = plaintext.encode()
-    xored = bytes(b ^ key[i % len(key)] for i, b in enumerate(data))
-    return base64.b64encode(xored).decode()
+def field_cipher_for(ciphertext: str):
+    for cipher in PREFIXED_CIPHERS:
+        if ciphertext.startswith(cipher.prefix):
+            return cipher
+    return FIELD_CIPHERS["xor"]
 
 
-def simple_decrypt(ciphertext: str) -> str:
+@timed_phase("crypto")
+def encrypt_field(plaintext: str) -> str:
+    cipher = FIELD_CIPHERS[FIELD_CIPHER]
+    return cipher.prefix + base64.b64encode(cipher.encrypt(plaintext.encode())).decode()
+
+
+@timed_phase("crypto")
+def decrypt_field(ciphertext: str) -> str:
     try:
-        key = hashlib.sha256(APP_SECRET.encode()).digest()
-        data = base64.b64decode(ciphertext.encode())
-        plain = bytes(b ^ key[i % len(key)] for i, b in enumerate(data))
-        return plain.decode()
+        cipher = field_cipher_for(ciphertext)
+        data = base64.b64decode(ciphertext[len(cipher.prefix):].encode())
+        return cipher.decrypt(data).decode()
     except Exception:
         return ""
 
 
+@timed_phase("crypto")
+def decrypt_fields(values: list) -> list:
+    """Пакетная расшифровка для списков; пустые значения дают "", битые — тоже ""."""
+    result = [""] * len(values)
+    groups = {}
+    for index, value in enumerate(values):
+        if not value:
+            continue
+        cipher = field_cipher_for(value)
+        try:
+            blob = binascii.a2b_base64(value[len(cipher.prefix):])
+        except ValueError:
+            continue
+        _, indexes, blobs = groups.setdefault(cipher.prefix, (cipher, [], []))
+        indexes.append(index)
+        blobs.append(blob)
+    for cipher, indexes, blobs in groups.values():
+        try:
+            plains = cipher.decrypt_many(blobs)
+        except Exception:
+            # Одна битая запись не должна ломать весь список
+            plains = []
+            for blob in blobs:
+                try:
+                    plains.append(cipher.decrypt(blob))
+                except Exception:
+                    plains.append(b"")
+        for index, plain in zip(indexes, plains):
+            try:
+                result[index] = plain.decode()
+            except UnicodeDecodeError:
+                pass
+    return result
+
+
 def clean_url(value: str) -> str:
     url = (value or "").strip()
     if not url:
@@ -170,491 +1054,2375 @@ def clean_url(value: str) -> str:
 def resolve_path(rel_path: str) -> str:
     rel = (rel_path or "").strip()
     rel = rel.lstrip("/")
-    safe_path = os.path.normpath(os.path.join(FILES_ROOT, rel))
-    if not safe_path.startswith(os.path.abspath(FILES_ROOT)):
+    root = os.path.abspath(FILES_ROOT)
+    safe_path = os.path.normpath(os.path.join(root, rel))
+    if safe_path != root and not safe_path.startswith(root + os.sep):
+        raise ValueError("invalid_path")
+    if is_internal_path(safe_path):
         raise ValueError("invalid_path")
     return safe_path
 
 
-def parse_json(handler: BaseHTTPRequestHandler):
-    length = int(handler.headers.get("Content-Length", "0"))
-    raw = handler.rfile.read(length) if length else b""
-    if not raw:
-        return {}
-    try:
-        return json.loads(raw.decode())
-    except json.JSONDecodeError:
-        return {}
-
+def is_internal_path(path: str) -> bool:
+    path = os.path.abspath(path)
+    return any(path == internal or path.startswith(internal + os.sep) for internal in INTERNAL_DIRS)
 
-def json_response(handler: BaseHTTPRequestHandler, status: int, payload: dict, extra_headers=None):
-    handler.send_response(status)
-    handler.send_header("Content-Type", "application/json; charset=utf-8")
-    handler.send_header("Access-Control-Allow-Origin", FRONTEND_ORIGIN)
-    handler.send_header("Access-Control-Allow-Credentials", "true")
-    if extra_headers:
-        for k, v in extra_headers.items():
-            handler.send_header(k, v)
-    handler.end_headers()
-    handler.wfile.write(json.dumps(payload).encode())
 
+DIR_SORT_KEYS = {
+    "name": lambda e: e["name"].casefold(),
+    "size": lambda e: e["size"],
+    "modified": lambda e: e["modified"],
+}
 
-def set_session_cookie(handler: BaseHTTPRequestHandler, token: str):
-    cookie = f"session={token}; Path=/; HttpOnly; SameSite=Lax"
-    handler.send_header("Set-Cookie", cookie)
 
+def file_etag(info: os.stat_result) -> str:
+    return f'"{info.st_ino:x}-{info.st_size:x}-{info.st_mtime_ns:x}"'
 
-def get_session_token(handler: BaseHTTPRequestHandler):
-    cookie_header = handler.headers.get("Cookie")
-    if not cookie_header:
-        return None
-    for part in cookie_header.split(';'):
-        if '=' not in part:
-            continue
-        name, value = part.strip().split('=', 1)
-        if name == 'session':
-            return value
-    return None
 
+def scan_dir(path: str) -> list:
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if is_internal_path(entry.path):
+                continue
+            info = entry.stat()
+            entries.append(
+                {
+                    "name": entry.name,
+                    "is_dir": entry.is_dir(),
+                    "size": info.st_size,
+                    "modified": int(info.st_mtime),
+                    "etag": file_etag(info),
+                }
+            )
+    return entries
 
-def with_session(handler: BaseHTTPRequestHandler):
-    token = get_session_token(handler)
-    if not token:
-        return None
-    conn = get_conn()
-    now = int(time.time())
-    row = conn.execute(
-        "SELECT sessions.token, sessions.user_id, users.email, users.nickname, users.full_name, users.phone, users.password_manager_url, users.is_admin "
-        "FROM sessions JOIN users ON users.id = sessions.user_id WHERE sessions.token = ? AND sessions.expires_at > ?",
-        (token, now),
-    ).fetchone()
-    conn.close()
-    return row
 
+class DirCache:
+    """Кэш листингов каталогов и рекурсивных итогов (размер, файлы, папки).
 
-def is_admin(session) -> bool:
-    return bool(session and len(session) > 7 and session[7])
+    Листинг сверяется с mtime каталога, так что изменения из других процессов
+    prefork видны сразу; размеры файлов, переписанных на месте, и итоги по
+    поддереву — после invalidate() или через ttl.
+    """
 
+    def __init__(self, size: int, totals_size: int, ttl: float):
+        self.size = size
+        self.totals_size = totals_size
+        self.ttl = ttl
+        self.listings = OrderedDict()
+        self.subtree_totals = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-class AppHandler(BaseHTTPRequestHandler):
-    def log_message(self, format, *args):  # noqa: N802
-        # Тише в контейнере
-        return
+    def listing(self, path: str, sort: str = "name", descending: bool = False) -> list:
+        """Записи каталога: папки первыми, затем по ключу sort. Отсортированные варианты тоже кэшируются."""
+        mtime_ns = os.stat(path).st_mtime_ns
+        now = time.time()
+        with self.lock:
+            cached = self.listings.get(path)
+            if cached is not None and cached["mtime_ns"] == mtime_ns and cached["deadline"] > now:
+                self.listings.move_to_end(path)
+                self.hits += 1
+            else:
+                cached = None
+                self.misses += 1
+        if cached is None:
+            cached = {"mtime_ns": mtime_ns, "deadline": now + self.ttl, "entries": scan_dir(path), "sorted": {}}
+            if self.size > 0:
+                with self.lock:
+                    self.listings[path] = cached
+                    self.listings.move_to_end(path)
+                    while len(self.listings) > self.size:
+                        self.listings.popitem(last=False)
+        order = cached["sorted"].get((sort, descending))
+        if order is None:
+            key = DIR_SORT_KEYS[sort]
+            order = sorted(cached["entries"], key=key, reverse=descending)
+            order.sort(key=lambda e: not e["is_dir"])
+            cached["sorted"][(sort, descending)] = order
+        return order
 
-    def do_OPTIONS(self):  # noqa: N802
-        self.send_response(204)
-        self.send_header("Access-Control-Allow-Origin", FRONTEND_ORIGIN)
-        self.send_header("Access-Control-Allow-Credentials", "true")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
-        self.send_header("Access-Control-Allow-Methods", "GET,POST,PUT,DELETE,OPTIONS")
-        self.end_headers()
+    def totals(self, path: str) -> dict:
+        now = time.time()
+        with self.lock:
+            cached = self.subtree_totals.get(path)
+            if cached is not None and cached[0] > now:
+                self.subtree_totals.move_to_end(path)
+                return cached[1]
+        size = files = dirs = 0
+        with os.scandir(path) as it:
+            for entry in it:
+                if is_internal_path(entry.path):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub = self.totals(entry.path)
+                        size += sub["size"]
+                        files += sub["files"]
+                        dirs += sub["dirs"] + 1
+                    elif entry.is_file(follow_symlinks=False):
+                        size += entry.stat(follow_symlinks=False).st_size
+                        files += 1
+                except OSError:
+                    # Удалили во время обхода или нет прав — просто не считаем
+                    continue
+        result = {"size": size, "files": files, "dirs": dirs}
+        if self.totals_size > 0:
+            with self.lock:
+                self.subtree_totals[path] = (now + self.ttl, result)
+                while len(self.subtree_totals) > self.totals_size:
+                    self.subtree_totals.popitem(last=False)
+        return result
 
-    def do_GET(self):  # noqa: N802
-        parsed = urlparse(self.path)
-        if parsed.path == "/api/health":
-            json_response(self, 200, {"status": "ok"})
-            return
+    def invalidate(self, path: str):
+        """Сбрасывает каталог (или каталог файла) и всех его предков до FILES_ROOT."""
+        root = os.path.abspath(FILES_ROOT)
+        path = os.path.abspath(path)
+        with self.lock:
+            while True:
+                self.listings.pop(path, None)
+                self.subtree_totals.pop(path, None)
+                if path == root or not path.startswith(root):
+                    break
+                path = os.path.dirname(path)
 
-        if parsed.path == "/api/me":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            user = {
-                "nickname": session[3],
-                "email": session[2],
-                "full_name": simple_decrypt(session[4]) if session[4] else None,
-                "phone": simple_decrypt(session[5]) if session[5] else None,
-                "password_manager_url": simple_decrypt(session[6]) if session[6] else None,
-                "is_admin": bool(session[7]),
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.listings),
+                "capacity": self.size,
+                "totals": len(self.subtree_totals),
+                "hits": self.hits,
+                "misses": self.misses,
             }
-            json_response(self, 200, {"user": user})
+
+
+DIR_CACHE = DirCache(DIR_CACHE_SIZE, DIR_TOTALS_SIZE, DIR_CACHE_TTL)
+
+
+class ApiError(Exception):
+    """Ошибка с HTTP-статусом и кодом для {"error": code}; ловится error_middleware."""
+
+    def __init__(self, status: int, code: str):
+        super().__init__(code)
+        self.status = status
+        self.code = code
+
+
+class UploadError(ApiError):
+    pass
+
+
+class UploadProgress:
+    """Сколько байт принято по каждой загрузке; хранит последние max_entries."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self, upload_id: str, total: int):
+        with self.lock:
+            self.entries[upload_id] = {"received": 0, "total": total, "done": False, "error": None}
+            self.entries.move_to_end(upload_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def advance(self, upload_id: str, size: int):
+        with self.lock:
+            entry = self.entries.get(upload_id)
+            if entry is not None:
+                entry["received"] += size
+
+    def finish(self, upload_id: str, error: str = None):
+        with self.lock:
+            entry = self.entries.get(upload_id)
+            if entry is not None:
+                entry["done"] = True
+                entry["error"] = error
+
+    def get(self, upload_id: str):
+        with self.lock:
+            entry = self.entries.get(upload_id)
+            return dict(entry) if entry is not None else None
+
+
+UPLOAD_PROGRESS = UploadProgress()
+
+
+class BodyReader:
+    """Чтение тела запроса не дальше Content-Length, с возвратом лишнего в буфер."""
+
+    def __init__(self, rfile, length: int, upload_id: str):
+        self.rfile = rfile
+        self.remaining = length
+        self.upload_id = upload_id
+        self.buffer = b""
+
+    def read(self, size: int) -> bytes:
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        if self.remaining <= 0:
+            return b""
+        data = self.rfile.read(min(size, self.remaining))
+        if not data:
+            raise UploadError(400, "incomplete_body")
+        self.remaining -= len(data)
+        UPLOAD_PROGRESS.advance(self.upload_id, len(data))
+        return data
+
+    def unread(self, data: bytes):
+        self.buffer = data + self.buffer
+
+    def read_until(self, marker: bytes, limit: int = 16 * 1024) -> bytes:
+        data = b""
+        while marker not in data:
+            if len(data) > limit:
+                raise UploadError(400, "invalid_multipart")
+            chunk = self.read(4096)
+            if not chunk:
+                raise UploadError(400, "invalid_multipart")
+            data += chunk
+        head, _, rest = data.partition(marker)
+        self.unread(rest)
+        return head
+
+
+class HashingWriter:
+    def __init__(self, out):
+        self.out = out
+        self.digest = hashlib.sha256()
+
+    def write(self, data: bytes):
+        self.digest.update(data)
+        return self.out.write(data)
+
+
+def copy_to_staging(write_chunks):
+    """Пишет файл во временный в STAGING_DIR; при ошибке временный файл удаляется.
+
+    Возвращает (путь, sha256). Хеш считается по ходу записи и только при FILES_DEDUP, иначе None.
+    """
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix="upload-", dir=STAGING_DIR)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            writer = HashingWriter(out) if FILES_DEDUP else out
+            write_chunks(writer)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path, writer.digest.hexdigest() if FILES_DEDUP else None
+
+
+def receive_raw(reader: BodyReader):
+    def write_chunks(out):
+        while True:
+            chunk = reader.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                return
+            out.write(chunk)
+
+    return copy_to_staging(write_chunks)
+
+
+def receive_multipart(reader: BodyReader, boundary: str):
+    """Первая часть с filename из multipart/form-data -> (имя файла, временный путь, sha256)."""
+    delimiter = b"--" + boundary.encode("latin-1")
+    reader.read_until(delimiter + b"\r\n")
+    while True:
+        headers = parse_headers(io.BytesIO(reader.read_until(b"\r\n\r\n") + b"\r\n\r\n"))
+        filename = headers.get_param("filename", header="Content-Disposition")
+        if filename:
+            filename = email.utils.collapse_rfc2231_value(filename)
+        end_marker = b"\r\n" + delimiter
+
+        def write_chunks(out):
+            tail = b""
+            while True:
+                chunk = reader.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    raise UploadError(400, "invalid_multipart")
+                data = tail + chunk
+                index = data.find(end_marker)
+                if index >= 0:
+                    if out is not None:
+                        out.write(data[:index])
+                    reader.unread(data[index + len(end_marker):])
+                    return
+                # Хвост может содержать начало разделителя — оставляем его до следующего чтения
+                keep = len(end_marker) - 1
+                if out is not None:
+                    out.write(data[:-keep])
+                tail = data[-keep:]
+
+        if filename:
+            tmp_path, digest = copy_to_staging(write_chunks)
+            # Остаток тела (другие части, эпилог) не нужен
+            while reader.read(UPLOAD_CHUNK_BYTES):
+                pass
+            return os.path.basename(filename.replace("\\", "/")), tmp_path, digest
+        write_chunks(None)
+        if reader.read(2) != b"\r\n":
+            raise UploadError(400, "file_part_required")
+
+
+def read_request_body(handler: BaseHTTPRequestHandler, max_bytes: int) -> bytes:
+    """Тело запроса целиком. Слишком большое не читается — 413."""
+    try:
+        length = int(handler.headers.get("Content-Length", "0"))
+    except ValueError:
+        length = -1
+    if length < 0:
+        handler.close_connection = True
+        raise ApiError(400, "invalid_content_length")
+    if length > max_bytes:
+        # Непрочитанное тело сломало бы следующий запрос на этом соединении
+        handler.close_connection = True
+        raise ApiError(413, "body_too_large")
+    raw = handler.rfile.read(length) if length else b""
+    handler.body_pending = 0
+    return raw
+
+
+def parse_json(handler: BaseHTTPRequestHandler, max_bytes: int = JSON_MAX_BYTES):
+    """Тело запроса как JSON; битый JSON даёт {}."""
+    raw = read_request_body(handler, max_bytes)
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw.decode())
+    except json.JSONDecodeError:
+        return {}
+
+
+NOTE_FIELDS = ("id", "title", "content_md", "published", "created_at", "updated_at")
+# Поле ответа -> колонка в password_items; *_enc расшифровываются
+PASSWORD_FIELDS = {
+    "id": "id",
+    "title": "title",
+    "login": "login_enc",
+    "password": "password_enc",
+    "url": "url_enc",
+    "notes": "notes_enc",
+    "created_at": "created_at",
+    "updated_at": "updated_at",
+}
+
+
+def encode_cursor(updated_at: int, item_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{updated_at}:{item_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    updated_at, item_id = raw.split(":", 1)
+    return int(updated_at), int(item_id)
+
+
+def parse_list_query(query: str, allowed) -> dict:
+    """fields=, limit= (число или all) и cursor= для списков. ValueError с кодом ошибки при неверных значениях."""
+    qs = parse_qs(query)
+    fields = list(allowed)
+    if qs.get("fields"):
+        fields = [f for f in qs["fields"][0].split(",") if f]
+        if not fields or any(f not in allowed for f in fields):
+            raise ValueError("invalid_fields")
+    limit = PAGE_DEFAULT_LIMIT
+    value = qs.get("limit", [""])[0]
+    if value == "all":
+        limit = None
+    elif value:
+        try:
+            limit = int(value)
+        except ValueError:
+            raise ValueError("invalid_limit")
+        if limit < 1:
+            raise ValueError("invalid_limit")
+    cursor = None
+    if qs.get("cursor"):
+        try:
+            cursor = decode_cursor(qs["cursor"][0])
+        except (ValueError, UnicodeDecodeError, binascii.Error):
+            raise ValueError("invalid_cursor")
+    if limit is not None:
+        limit = min(limit, PAGE_MAX_LIMIT)
+    return {"fields": fields, "limit": limit, "cursor": cursor}
+
+
+def fetch_page(conn, table: str, columns, user_id: int, params: dict):
+    """Страница строк пользователя по ключу (updated_at, id) от новых к старым.
+
+    limit None (limit=all) — все строки. Вторым значением — курсор следующей страницы или None.
+    """
+    select = ", ".join(dict.fromkeys(["id", "updated_at", *columns]))
+    sql = f"SELECT {select} FROM {table} WHERE user_id = ?"
+    args = [user_id]
+    if params["cursor"]:
+        sql += " AND (updated_at, id) < (?, ?)"
+        args.extend(params["cursor"])
+    sql += " ORDER BY updated_at DESC, id DESC"
+    if params["limit"]:
+        sql += " LIMIT ?"
+        args.append(params["limit"] + 1)
+    rows = conn.execute(sql, args).fetchall()
+    next_cursor = None
+    if params["limit"] and len(rows) > params["limit"]:
+        rows = rows[: params["limit"]]
+        next_cursor = encode_cursor(rows[-1]["updated_at"], rows[-1]["id"])
+    return rows, next_cursor
+
+
+def sync_changes(conn, user_id: int, since: int, limit: int) -> dict:
+    """Изменённые и удалённые после seq=since записи пользователя, одним снимком БД.
+
+    since=0 или ниже горизонта сжатия tombstones — полная выборка с reset: клиент
+    заменяет локальные данные; она не режется на страницы, иначе следующая страница
+    снова попала бы под горизонт. Иначе не больше limit изменений по порядку seq;
+    если есть ещё, more=True, а seq — последнего отданного.
+    """
+    columns = {"notes": NOTE_FIELDS, "passwords": tuple(PASSWORD_FIELDS.values())}
+    # Без явной транзакции каждый SELECT видел бы свой снимок
+    conn.execute("BEGIN")
+    try:
+        counters = dict(conn.execute("SELECT name, value FROM sync_counters").fetchall())
+        reset = since == 0 or since < counters["compacted"]
+        if reset:
+            since, limit = 0, -1
+        changes = []
+        for kind, table in SYNC_TABLES.items():
+            rows = conn.execute(
+                f"SELECT seq, {', '.join(columns[kind])} FROM {table} WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (user_id, since, limit + 1 if limit > 0 else -1),
+            ).fetchall()
+            changes.extend((row["seq"], kind, row) for row in rows)
+        if not reset:
+            rows = conn.execute(
+                "SELECT seq, kind, item_id FROM sync_tombstones WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (user_id, since, limit + 1),
+            ).fetchall()
+            changes.extend((row["seq"], "deleted", row) for row in rows)
+    finally:
+        conn.rollback()
+    changes.sort(key=lambda change: change[0])
+    more = 0 < limit < len(changes)
+    if more:
+        changes = changes[:limit]
+    result = {
+        "seq": changes[-1][0] if more else counters["seq"],
+        "more": more,
+        "reset": reset,
+        "notes": [],
+        "passwords": [],
+        "deleted": {kind: [] for kind in SYNC_TABLES},
+    }
+    encrypted = [column for column in columns["passwords"] if column.endswith("_enc")]
+    plain = iter(decrypt_fields([row[column] for _, kind, row in changes if kind == "passwords" for column in encrypted]))
+    for _, kind, row in changes:
+        if kind == "deleted":
+            result["deleted"][row["kind"]].append(row["item_id"])
+        elif kind == "notes":
+            result["notes"].append({**{field: row[field] for field in NOTE_FIELDS}, "version": row["seq"]})
+        else:
+            result["passwords"].append(
+                {
+                    field: next(plain) if column.endswith("_enc") else row[column]
+                    for field, column in PASSWORD_FIELDS.items()
+                }
+            )
+    return result
+
+
+def parse_text_ops(ops, length: int) -> list:
+    """Правки [{"pos", "delete", "insert"}] -> [[pos, delete, insert], ...].
+
+    pos и delete — в символах исходного текста длиной length; правки идут
+    по возрастанию pos и не пересекаются. Иначе ApiError 400 invalid_ops.
+    """
+    if not isinstance(ops, list):
+        raise ApiError(400, "invalid_ops")
+    result = []
+    end = 0
+    for op in ops:
+        if not isinstance(op, dict):
+            raise ApiError(400, "invalid_ops")
+        pos, delete, insert = op.get("pos"), op.get("delete", 0), op.get("insert", "")
+        if type(pos) is not int or type(delete) is not int or not isinstance(insert, str):
+            raise ApiError(400, "invalid_ops")
+        if pos < end or delete < 0 or pos + delete > length:
+            raise ApiError(400, "invalid_ops")
+        if delete or insert:
+            result.append([pos, delete, insert])
+        end = pos + delete
+    return result
+
+
+def apply_text_ops(text: str, ops: list) -> str:
+    parts = []
+    cursor = 0
+    for pos, delete, insert in ops:
+        parts.append(text[cursor:pos])
+        parts.append(insert)
+        cursor = pos + delete
+    parts.append(text[cursor:])
+    return "".join(parts)
+
+
+def diff_text_ops(old: str, new: str) -> list:
+    """Правки old -> new по строкам (для PUT с полным текстом)."""
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    offsets = [0]
+    for line in old_lines:
+        offsets.append(offsets[-1] + len(line))
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    return [
+        [offsets[i1], offsets[i2] - offsets[i1], "".join(new_lines[j1:j2])]
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    ]
+
+
+def save_note_revision(conn, note_id: int, base_version: int, old_text: str, version: int, text: str, ops: list):
+    """Записывает версию заметки дельтой от base_version или снимком.
+
+    Снимок пишется, если base_version нет в истории (заметка старше истории или
+    менялась пакетом) — тогда сначала снимок старого текста, — раз в
+    NOTE_SNAPSHOT_EVERY версий и когда дельта не короче самого текста.
+    """
+    now = int(time.time())
+    recent = conn.execute(
+        "SELECT version, base_version IS NULL FROM note_revisions WHERE note_id = ? ORDER BY version DESC LIMIT ?",
+        (note_id, NOTE_SNAPSHOT_EVERY),
+    ).fetchall()
+    if not recent or recent[0][0] != base_version:
+        conn.execute(
+            "INSERT OR REPLACE INTO note_revisions (note_id, version, base_version, data, created_at) VALUES (?, ?, NULL, ?, ?)",
+            (note_id, base_version, old_text, now),
+        )
+        recent = [(base_version, 1)]
+    deltas = next((index for index, (_, snapshot) in enumerate(recent) if snapshot), len(recent))
+    delta = json.dumps(ops, ensure_ascii=False, separators=(",", ":"))
+    if deltas + 1 >= NOTE_SNAPSHOT_EVERY or len(delta) >= len(text):
+        conn.execute(
+            "INSERT INTO note_revisions (note_id, version, base_version, data, created_at) VALUES (?, ?, NULL, ?, ?)",
+            (note_id, version, text, now),
+        )
+    else:
+        conn.execute(
+            "INSERT INTO note_revisions (note_id, version, base_version, data, created_at) VALUES (?, ?, ?, ?, ?)",
+            (note_id, version, base_version, delta, now),
+        )
+    if NOTE_REVISIONS_KEEP > 0:
+        oldest = conn.execute(
+            "SELECT version FROM note_revisions WHERE note_id = ? ORDER BY version DESC LIMIT 1 OFFSET ?",
+            (note_id, NOTE_REVISIONS_KEEP - 1),
+        ).fetchone()
+        if oldest:
+            # Дельты опираются на снимок до них: удаляется только то, что старше снимка
+            snapshot = conn.execute(
+                "SELECT MAX(version) FROM note_revisions WHERE note_id = ? AND base_version IS NULL AND version <= ?",
+                (note_id, oldest[0]),
+            ).fetchone()[0]
+            if snapshot is not None:
+                conn.execute("DELETE FROM note_revisions WHERE note_id = ? AND version < ?", (note_id, snapshot))
+
+
+def note_revision_text(conn, note_id: int, version: int):
+    """Текст версии: ближайший снимок не позже неё плюс дельты; None, если цепочки нет."""
+    snapshot = conn.execute(
+        "SELECT version, data FROM note_revisions WHERE note_id = ? AND version <= ? AND base_version IS NULL "
+        "ORDER BY version DESC LIMIT 1",
+        (note_id, version),
+    ).fetchone()
+    if snapshot is None:
+        return None
+    text, current = snapshot["data"], snapshot["version"]
+    rows = conn.execute(
+        "SELECT version, base_version, data FROM note_revisions WHERE note_id = ? AND version > ? AND version <= ? "
+        "ORDER BY version",
+        (note_id, current, version),
+    )
+    for row in rows:
+        if row["base_version"] != current:
+            return None
+        text, current = apply_text_ops(text, json.loads(row["data"])), row["version"]
+    return text if current == version else None
+
+
+def requested_version(handler, data: dict):
+    """Версия, от которой сделана правка: base_version в теле или If-Match. None — не указана."""
+    value = data.get("base_version")
+    if value is None:
+        header = (handler.headers.get("If-Match") or "").strip()
+        if not header:
+            return None
+        # ETag сжатого ответа несёт суффикс кодировки ("7-gzip"), версия — до него
+        value = header.removeprefix("W/").strip('"').split("-", 1)[0]
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ApiError(400, "invalid_version")
+
+
+def note_values(data: dict, row=None) -> tuple:
+    """(title, content_md, published) из тела запроса; row — текущая заметка при частичном обновлении."""
+    if row is None:
+        row = {"title": "", "content_md": "", "published": 0}
+    title = (data.get("title", row["title"]) or "").strip()
+    content = data.get("content")
+    if content is None:
+        content = row["content_md"]
+    published = row["published"]
+    if "published" in data:
+        published = 1 if data.get("published") else 0
+    if not title:
+        raise ApiError(400, "title_required")
+    return title, content, published
+
+
+def password_values(data: dict, row=None) -> tuple:
+    """(title, login_enc, password_enc, url_enc, notes_enc); без row — новая запись, пароль обязателен."""
+    if row is None:
+        title = (data.get("title") or "").strip()
+        login_val = (data.get("login") or "").strip()
+        password_val = data.get("password") or ""
+        url_val = clean_url(data.get("url"))
+        notes_val = data.get("notes") or ""
+        if not title or not password_val:
+            raise ApiError(400, "title_and_password_required")
+        return (
+            title,
+            encrypt_field(login_val) if login_val else None,
+            encrypt_field(password_val),
+            encrypt_field(url_val) if url_val else None,
+            encrypt_field(notes_val) if notes_val else None,
+        )
+    login_val = data.get("login")
+    password_val = data.get("password")
+    url_val = data.get("url")
+    notes_val = data.get("notes")
+    return (
+        (data.get("title") or row["title"]).strip(),
+        encrypt_field(login_val) if login_val is not None else row["login_enc"],
+        encrypt_field(password_val) if password_val is not None else row["password_enc"],
+        encrypt_field(clean_url(url_val)) if url_val is not None else row["url_enc"],
+        encrypt_field(notes_val) if notes_val is not None else row["notes_enc"],
+    )
+
+
+# Тип записи в /api/batch -> таблица, изменяемые колонки и разбор тела
+BATCH_TYPES = {
+    "note": ("notes", ("title", "content_md", "published"), note_values),
+    "password": ("password_items", ("title", "login_enc", "password_enc", "url_enc", "notes_enc"), password_values),
+}
+BATCH_ACTIONS = ("create", "update", "delete")
+
+
+def parse_batch_op(op) -> tuple:
+    """(action, type, id, data) одной операции пакета; ApiError при неверном формате."""
+    if not isinstance(op, dict) or op.get("op") not in BATCH_ACTIONS or op.get("type") not in BATCH_TYPES:
+        raise ApiError(400, "invalid_operation")
+    item_id = None
+    if op["op"] != "create":
+        item_id = op.get("id")
+        if not isinstance(item_id, int) or isinstance(item_id, bool):
+            raise ApiError(400, "invalid_id")
+    data = op.get("data") or {}
+    if not isinstance(data, dict):
+        raise ApiError(400, "invalid_data")
+    return op["op"], op["type"], item_id, data
+
+
+def fetch_owned(conn, table: str, columns, user_id: int, ids) -> dict:
+    """Записи пользователя по id -> dict строки; IN частями из-за лимита параметров SQLite."""
+    ids = list(ids)
+    rows = {}
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        sql = f"SELECT id, {', '.join(columns)} FROM {table} WHERE user_id = ? AND id IN ({', '.join('?' * len(chunk))})"
+        for row in conn.execute(sql, [user_id, *chunk]):
+            rows[row["id"]] = dict(row)
+    return rows
+
+
+def batch_not_applied(results: list) -> list:
+    """Атомарный пакет с ошибкой: остальные операции получают 424 not_applied."""
+    return [
+        result if result and result["status"] >= 400 else {"status": 424, "error": "not_applied"}
+        for result in results
+    ]
+
+
+def apply_batch(conn, user_id: int, operations: list, atomic: bool = False) -> tuple:
+    """Применяет операции одной транзакцией: по одному executemany на тип и действие.
+
+    Возвращает (results, applied): результат на каждую операцию в том же порядке
+    ({"status", "id"} или {"status", "error"}) и число применённых. Ошибка в одной
+    операции не мешает остальным; с atomic при любой ошибке не применяется ничего.
+    Удаление несуществующей записи, как и DELETE, не ошибка.
+    """
+    results = [None] * len(operations)
+    creates = {kind: [] for kind in BATCH_TYPES}
+    changes = []
+    for index, op in enumerate(operations):
+        try:
+            action, kind, item_id, data = parse_batch_op(op)
+            if action == "create":
+                # Шифрование до BEGIN IMMEDIATE, чтобы не держать блокировку записи
+                creates[kind].append((index, BATCH_TYPES[kind][2](data)))
+            else:
+                changes.append((index, action, kind, item_id, data))
+        except ApiError as exc:
+            results[index] = {"status": exc.status, "error": exc.code}
+        except (TypeError, AttributeError):
+            results[index] = {"status": 400, "error": "invalid_data"}
+    if atomic and any(results):
+        return batch_not_applied(results), 0
+    now = int(time.time())
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        current = {}
+        for kind, (table, columns, _) in BATCH_TYPES.items():
+            ids = {item_id for _, action, op_kind, item_id, _ in changes if op_kind == kind and action == "update"}
+            current[kind] = fetch_owned(conn, table, columns, user_id, ids)
+        updates = {kind: {} for kind in BATCH_TYPES}
+        deletes = {kind: set() for kind in BATCH_TYPES}
+        # Порядок операций учитывается здесь: после удаления обновление той же записи — 404,
+        # повторные обновления сливаются в одно
+        for index, action, kind, item_id, data in changes:
+            _, columns, values_for = BATCH_TYPES[kind]
+            if action == "delete":
+                current[kind].pop(item_id, None)
+                updates[kind].pop(item_id, None)
+                deletes[kind].add(item_id)
+                results[index] = {"status": 200, "id": item_id}
+                continue
+            row = current[kind].get(item_id)
+            if row is None:
+                results[index] = {"status": 404, "error": "not_found"}
+                continue
+            try:
+                values = values_for(data, row)
+            except ApiError as exc:
+                results[index] = {"status": exc.status, "error": exc.code}
+                continue
+            except (TypeError, AttributeError):
+                results[index] = {"status": 400, "error": "invalid_data"}
+                continue
+            row.update(zip(columns, values))
+            updates[kind][item_id] = values
+            results[index] = {"status": 200, "id": item_id}
+        # Создания пока без результата: их id появятся после INSERT
+        if atomic and any(result and result["status"] >= 400 for result in results):
+            conn.rollback()
+            return batch_not_applied(results), 0
+        for kind, (table, columns, _) in BATCH_TYPES.items():
+            if creates[kind]:
+                conn.executemany(
+                    f"INSERT INTO {table} (user_id, {', '.join(columns)}, created_at, updated_at) "
+                    f"VALUES (?, {', '.join('?' * len(columns))}, ?, ?)",
+                    [(user_id, *values, now, now) for _, values in creates[kind]],
+                )
+                # AUTOINCREMENT под блокировкой записи выдаёт id подряд
+                last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                first_id = last_id - len(creates[kind]) + 1
+                for offset, (index, _) in enumerate(creates[kind]):
+                    results[index] = {"status": 201, "id": first_id + offset}
+            if updates[kind]:
+                assignments = ", ".join(f"{column} = ?" for column in columns)
+                conn.executemany(
+                    f"UPDATE {table} SET {assignments}, updated_at = ? WHERE id = ? AND user_id = ?",
+                    [(*values, now, item_id, user_id) for item_id, values in updates[kind].items()],
+                )
+            if deletes[kind]:
+                conn.executemany(
+                    f"DELETE FROM {table} WHERE id = ? AND user_id = ?",
+                    [(item_id, user_id) for item_id in deletes[kind]],
+                )
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return results, sum(1 for result in results if result["status"] < 400)
+
+
+# Заголовки колонок экспорта (свой JSON, Bitwarden, Chrome, Firefox) -> поле записи
+IMPORT_ALIASES = {
+    "note": {
+        "title": "title",
+        "name": "title",
+        "content": "content",
+        "content_md": "content",
+        "published": "published",
+    },
+    "password": {
+        "title": "title",
+        "name": "title",
+        "login": "login",
+        "username": "login",
+        "login_username": "login",
+        "password": "password",
+        "login_password": "password",
+        "url": "url",
+        "uri": "url",
+        "login_uri": "url",
+        "notes": "notes",
+        "note": "notes",
+        "extra": "notes",
+    },
+}
+
+
+def parse_import(raw: bytes, content_type: str, kind: str) -> list:
+    """Операции create из экспорта: CSV с заголовком или JSON — массив либо ответ списка."""
+    try:
+        text = raw.decode("utf-8-sig")
+        if content_type in ("text/csv", "application/csv"):
+            records = list(csv.DictReader(io.StringIO(text)))
+        else:
+            records = json.loads(text)
+            if isinstance(records, dict):
+                records = records.get("items", records.get("notes"))
+    except (UnicodeDecodeError, json.JSONDecodeError, csv.Error):
+        raise ApiError(400, "invalid_import")
+    if not isinstance(records, list):
+        raise ApiError(400, "invalid_import")
+    aliases = IMPORT_ALIASES[kind]
+    operations = []
+    for record in records:
+        data = record
+        if isinstance(record, dict):
+            data = {}
+            for key, value in record.items():
+                field = aliases.get(str(key).strip().lower())
+                if field is None or field in data or value in (None, ""):
+                    continue
+                if field == "published":
+                    # В CSV это строка: "0" и "false" не должны публиковать
+                    data[field] = str(value).strip().lower() in ("1", "true", "yes")
+                else:
+                    data[field] = value if isinstance(value, str) else str(value)
+        operations.append({"op": "create", "type": kind, "data": data})
+    return operations
+
+
+def place_upload(tmp_path: str, rel_path: str, name: str, digest: str = None) -> str:
+    """Атомарно переносит принятый файл в FILES_ROOT/rel_path/name.
+
+    При FILES_DEDUP содержимое уходит в хранилище блобов, а на месте файла — жёсткая ссылка.
+    """
+    try:
+        dest = resolve_path(os.path.join(rel_path, name))
+    except ValueError:
+        raise UploadError(400, "invalid_path")
+    if os.path.isdir(dest):
+        raise UploadError(400, "path_is_directory")
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if FILES_DEDUP:
+        link_blob(dest, digest or file_sha256(tmp_path), tmp_path)
+    else:
+        os.replace(tmp_path, dest)
+        release_file(dest)
+    DIR_CACHE.invalidate(dest)
+    return dest
+
+
+def blob_path(digest: str) -> str:
+    return os.path.join(BLOBS_DIR, digest[:2], digest[2:4], digest)
+
+
+def store_blob(tmp_path: str, digest: str) -> str:
+    """Кладёт временный файл в хранилище под его хешем; если такой блоб уже есть, временный удаляется."""
+    path = blob_path(digest)
+    if os.path.exists(path):
+        os.unlink(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Общий inode нельзя править на месте — это изменило бы все копии
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, path)
+    return digest
+
+
+def link_blob(dest: str, digest: str, tmp_path: str = None):
+    """Ставит на место dest жёсткую ссылку на блоб (tmp_path — новое содержимое) и ведёт счётчик ссылок.
+
+    Всё под блокировкой записи SQLite: параллельное удаление последней ссылки
+    (в том числе из другого процесса prefork) не успеет убрать блоб между проверкой и link.
+    """
+    rel = os.path.relpath(dest, FILES_ROOT)
+    now = int(time.time())
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if tmp_path is not None:
+            store_blob(tmp_path, digest)
+        path = blob_path(digest)
+        size = os.path.getsize(path)
+        # rename() поверх ссылки на тот же inode ничего не делает и оставил бы временную ссылку
+        if not (os.path.exists(dest) and os.path.samefile(dest, path)):
+            tmp_link = os.path.join(STAGING_DIR, "upload-" + secrets.token_hex(8))
+            os.link(path, tmp_link)
+            try:
+                os.replace(tmp_link, dest)
+            except OSError:
+                os.unlink(tmp_link)
+                raise
+        # Сначала +1: при перезаливке того же содержимого блоб не должен дойти до нуля
+        conn.execute(
+            "INSERT INTO blobs (hash, size, refcount, created_at) VALUES (?, ?, 1, ?) "
+            "ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1",
+            (digest, size, now),
+        )
+        release_blob_ref(conn, rel)
+        conn.execute("INSERT INTO file_blobs (path, hash, created_at) VALUES (?, ?, ?)", (rel, digest, now))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def release_blob_ref(conn, rel: str):
+    """Снимает ссылку пути на блоб; блоб без ссылок удаляется. Вызывается внутри транзакции."""
+    row = conn.execute("SELECT hash FROM file_blobs WHERE path = ?", (rel,)).fetchone()
+    if row is None:
+        return
+    conn.execute("DELETE FROM file_blobs WHERE path = ?", (rel,))
+    conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?", (row[0],))
+    if conn.execute("SELECT refcount FROM blobs WHERE hash = ?", (row[0],)).fetchone()[0] <= 0:
+        conn.execute("DELETE FROM blobs WHERE hash = ?", (row[0],))
+        # Логические файлы — жёсткие ссылки, их данные от удаления блоба не пропадут
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(blob_path(row[0]))
+
+
+def release_file(path: str):
+    """После удаления или перезаписи файла мимо хранилища снимает его ссылку на блоб, если была."""
+    rel = os.path.relpath(path, FILES_ROOT)
+    conn = get_conn()
+    try:
+        if conn.execute("SELECT 1 FROM file_blobs WHERE path = ?", (rel,)).fetchone() is None:
             return
+        conn.execute("BEGIN IMMEDIATE")
+        release_blob_ref(conn, rel)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def link_known_blob(rel_path: str, name: str, digest: str, size: int):
+    """Мгновенная «загрузка» уже известного содержимого. None, если такого блоба нет."""
+    if not FILES_DEDUP or not re.fullmatch(r"[0-9a-f]{64}", digest or ""):
+        return None
+    try:
+        if os.path.getsize(blob_path(digest)) != size:
+            return None
+    except FileNotFoundError:
+        return None
+    try:
+        dest = resolve_path(os.path.join(rel_path, name))
+    except ValueError:
+        raise UploadError(400, "invalid_path")
+    if os.path.isdir(dest):
+        raise UploadError(400, "path_is_directory")
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        link_blob(dest, digest)
+    except FileNotFoundError:
+        # Последнюю ссылку удалили параллельно — пусть клиент загрузит файл
+        return None
+    DIR_CACHE.invalidate(dest)
+    return dest
+
+
+def dedup_existing_files() -> tuple:
+    """Переводит уже лежащие в FILES_ROOT файлы на хранилище блобов: (файлов, сэкономлено байт)."""
+    files = saved = 0
+    conn = get_conn()
+    known = {row[0] for row in conn.execute("SELECT path FROM file_blobs")}
+    conn.close()
+    for dirpath, dirnames, filenames in os.walk(FILES_ROOT):
+        dirnames[:] = [d for d in dirnames if not is_internal_path(os.path.join(dirpath, d))]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.relpath(path, FILES_ROOT) in known or not os.path.isfile(path) or os.path.islink(path):
+                continue
+            digest = file_sha256(path)
+            blob = blob_path(digest)
+            if os.path.exists(blob):
+                saved += os.path.getsize(path)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.chmod(path, 0o444)
+                os.link(path, blob)
+            link_blob(path, digest)
+            files += 1
+    return files, saved
+
+
+def blob_store_stats() -> dict:
+    conn = get_conn()
+    row = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * refcount), 0) FROM blobs").fetchone()
+    conn.close()
+    return {"enabled": FILES_DEDUP, "blobs": row[0], "stored_bytes": row[1], "logical_bytes": row[2]}
+
+
+def upload_session_dir(upload_id: str) -> str:
+    if not re.fullmatch(r"[0-9a-f]{32}", upload_id or ""):
+        raise UploadError(404, "not_found")
+    path = os.path.join(UPLOAD_SESSIONS_DIR, upload_id)
+    if not os.path.isdir(path):
+        raise UploadError(404, "not_found")
+    return path
+
+
+def save_upload_meta(session_dir: str, meta: dict):
+    tmp_path = os.path.join(session_dir, "meta.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(session_dir, "meta.json"))
+
+
+@contextlib.contextmanager
+def locked_upload_meta(upload_id: str):
+    """meta.json сессии под flock: параллельные куски (и процессы prefork) не теряют диапазоны."""
+    session_dir = upload_session_dir(upload_id)
+    with open(os.path.join(session_dir, "lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(os.path.join(session_dir, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise UploadError(404, "not_found")
+        yield session_dir, meta
+
+
+def merge_range(ranges: list, start: int, end: int) -> list:
+    merged = []
+    for lo, hi in sorted(ranges + [[start, end]]):
+        if merged and lo <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return merged
+
+
+def upload_status(meta: dict) -> dict:
+    received = sum(hi - lo for lo, hi in meta["ranges"])
+    return {
+        "id": meta["id"],
+        "path": meta["path"],
+        "name": meta["name"],
+        "size": meta["size"],
+        "received": received,
+        "ranges": meta["ranges"],
+        "complete": meta["ranges"] == [[0, meta["size"]]] or meta["size"] == 0,
+    }
+
+
+def create_chunked_upload(rel_path: str, name: str, size: int, sha256: str = None) -> dict:
+    try:
+        resolve_path(os.path.join(rel_path, name))
+    except ValueError:
+        raise UploadError(400, "invalid_path")
+    upload_id = secrets.token_hex(16)
+    session_dir = os.path.join(UPLOAD_SESSIONS_DIR, upload_id)
+    os.makedirs(session_dir)
+    with open(os.path.join(session_dir, "data"), "wb") as f:
+        f.truncate(size)
+    meta = {
+        "id": upload_id,
+        "path": rel_path,
+        "name": name,
+        "size": size,
+        "sha256": (sha256 or "").lower() or None,
+        "ranges": [],
+        "created_at": int(time.time()),
+    }
+    save_upload_meta(session_dir, meta)
+    return meta
+
+
+def write_upload_chunk(upload_id: str, offset: int, rfile, length: int, chunk_sha256: str = None) -> dict:
+    """Пишет кусок по смещению через pwrite; разные куски одной загрузки можно слать параллельно."""
+    with locked_upload_meta(upload_id) as (session_dir, meta):
+        if offset < 0 or offset + length > meta["size"]:
+            raise UploadError(416, "range_out_of_bounds")
+        # Разделяемый flock на время записи: /complete не переложит файл, пока кусок пишется
+        writers = open(os.path.join(session_dir, "writers"), "a")
+        fcntl.flock(writers, fcntl.LOCK_SH)
+    digest = hashlib.sha256()
+    try:
+        fd = os.open(os.path.join(session_dir, "data"), os.O_WRONLY)
+    except BaseException:
+        writers.close()
+        raise
+    try:
+        position = offset
+        remaining = length
+        while remaining:
+            data = rfile.read(min(UPLOAD_CHUNK_BYTES, remaining))
+            if not data:
+                raise UploadError(400, "incomplete_body")
+            os.pwrite(fd, data, position)
+            digest.update(data)
+            position += len(data)
+            remaining -= len(data)
+    finally:
+        os.close(fd)
+        writers.close()
+    if chunk_sha256 and digest.hexdigest() != chunk_sha256.lower():
+        # Диапазон не засчитывается, кусок нужно прислать заново
+        raise UploadError(422, "chunk_checksum_mismatch")
+    with locked_upload_meta(upload_id) as (session_dir, meta):
+        if length:
+            meta["ranges"] = merge_range(meta["ranges"], offset, offset + length)
+        meta["updated_at"] = int(time.time())
+        save_upload_meta(session_dir, meta)
+        return upload_status(meta)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(UPLOAD_CHUNK_BYTES)
+            if not data:
+                return digest.hexdigest()
+            digest.update(data)
+
+
+def complete_chunked_upload(upload_id: str, sha256: str = None) -> dict:
+    with locked_upload_meta(upload_id) as (session_dir, meta):
+        status = upload_status(meta)
+        if not status["complete"]:
+            raise UploadError(409, "upload_incomplete")
+        with open(os.path.join(session_dir, "writers"), "a") as writers:
+            try:
+                fcntl.flock(writers, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Повтор уже принятого куска ещё пишется в файл
+                raise UploadError(409, "upload_busy")
+            expected = (sha256 or "").lower() or meta["sha256"]
+            data_path = os.path.join(session_dir, "data")
+            if expected and file_sha256(data_path) != expected:
+                raise UploadError(422, "checksum_mismatch")
+            # Проверенный хеш не считается второй раз для FILES_DEDUP
+            place_upload(data_path, meta["path"], meta["name"], expected or None)
+            remove_upload_session(session_dir)
+    return status
+
+
+def remove_upload_session(session_dir: str):
+    for name in ("data", "meta.json", "meta.json.tmp", "lock", "writers"):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(os.path.join(session_dir, name))
+    with contextlib.suppress(OSError):
+        os.rmdir(session_dir)
+
+
+def sweep_stale_uploads(ttl: float = UPLOAD_SESSION_TTL) -> int:
+    """Удаляет брошенные загрузки и временные файлы потоковых загрузок старше ttl."""
+    removed = 0
+    cutoff = time.time() - ttl
+    if os.path.isdir(UPLOAD_SESSIONS_DIR):
+        for entry in os.scandir(UPLOAD_SESSIONS_DIR):
+            meta_path = os.path.join(entry.path, "meta.json")
+            try:
+                if os.stat(meta_path).st_mtime < cutoff:
+                    remove_upload_session(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                if entry.stat().st_mtime < cutoff:
+                    remove_upload_session(entry.path)
+                    removed += 1
+    if os.path.isdir(STAGING_DIR):
+        for entry in os.scandir(STAGING_DIR):
+            if entry.is_file() and entry.name.startswith("upload-") and entry.stat().st_mtime < cutoff:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(entry.path)
+                    removed += 1
+    return removed
+
+
+def search_available(conn) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'notes_fts'").fetchone() is not None
+
+
+def fts_query(text: str) -> str:
+    """Пользовательский текст -> безопасный запрос FTS5: все слова, последнее — как префикс."""
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return ""
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def parse_search_query(query: str) -> dict:
+    qs = parse_qs(query)
+    match = fts_query(qs.get("q", [""])[0])
+    if not match:
+        raise ValueError("query_required")
+    try:
+        limit = int(qs.get("limit", ["20"])[0])
+        offset = int(qs.get("offset", ["0"])[0])
+    except ValueError:
+        raise ValueError("invalid_limit")
+    if limit < 1 or offset < 0:
+        raise ValueError("invalid_limit")
+    return {"match": match, "limit": min(limit, PAGE_MAX_LIMIT), "offset": offset}
+
+
+def search_notes(conn, params: dict, user_id: int = None, published_only: bool = False):
+    """Поиск по заметкам с ранжированием bm25 (заголовок весит больше текста) и сниппетами."""
+    sql = (
+        "SELECT notes.id, notes.title, notes.published, notes.updated_at, users.email AS author_email, "
+        "snippet(notes_fts, 1, '**', '**', '…', 16) AS snippet, bm25(notes_fts, 10.0, 1.0) AS rank "
+        "FROM notes_fts JOIN notes ON notes.id = notes_fts.rowid JOIN users ON users.id = notes.user_id "
+        "WHERE notes_fts MATCH ?"
+    )
+    args = [params["match"]]
+    if user_id is not None:
+        sql += " AND notes.user_id = ?"
+        args.append(user_id)
+    if published_only:
+        sql += " AND notes.published = 1"
+    sql += " ORDER BY rank LIMIT ? OFFSET ?"
+    args.extend([params["limit"] + 1, params["offset"]])
+    rows = conn.execute(sql, args).fetchall()
+    next_offset = None
+    if len(rows) > params["limit"]:
+        rows = rows[: params["limit"]]
+        next_offset = params["offset"] + params["limit"]
+    return rows, next_offset
+
+
+def rebuild_search_index():
+    conn = sqlite3.connect(DB_PATH)
+    with conn:
+        if not create_search_index(conn):
+            raise SystemExit("SQLite собран без FTS5, поиск недоступен")
+        conn.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')")
+    count = conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+    conn.close()
+    print(f"Search index rebuilt: {count} notes")
+
+
+def compressor(coding: str, level: int = COMPRESS_LEVEL):
+    # wbits: 16+ — gzip-обёртка, без добавки — zlib (HTTP deflate)
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS if coding == "gzip" else zlib.MAX_WBITS)
+
+
+@timed_phase("serialize")
+def compress_body(body: bytes, coding: str, level: int = COMPRESS_LEVEL) -> bytes:
+    comp = compressor(coding, level)
+    return comp.compress(body) + comp.flush()
+
+
+def choose_encoding(handler: BaseHTTPRequestHandler):
+    encodings = accepted_encodings(handler)
+    wildcard = encodings.get("*", 0)
+    best, best_q = None, 0
+    # При равном q предпочитаем gzip
+    for coding in ("gzip", "deflate"):
+        q = encodings.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def encoded_etag(etag: str, coding) -> str:
+    """ETag варианта в Content-Encoding: у сжатого и исходного тела разные байты, validator не общий."""
+    return etag if coding is None else f'{etag[:-1]}-{coding}"'
+
+
+def bytes_response(
+    handler: BaseHTTPRequestHandler,
+    status: int,
+    body: bytes,
+    extra_headers=None,
+    content_type: str = "application/json; charset=utf-8",
+):
+    """Ответ с уже сериализованным телом (по умолчанию JSON); крупные тела сжимаются по Accept-Encoding."""
+    headers = dict(extra_headers or {})
+    coding = None
+    if len(body) >= COMPRESS_MIN_BYTES and "Content-Encoding" not in headers:
+        headers.setdefault("Vary", "Accept-Encoding")
+        coding = choose_encoding(handler)
+        if coding is not None and "ETag" in headers:
+            headers["ETag"] = encoded_etag(headers["ETag"], coding)
+    handler.send_response(status)
+    handler.send_header("Content-Type", content_type)
+    handler.send_header("Access-Control-Allow-Origin", FRONTEND_ORIGIN)
+    handler.send_header("Access-Control-Allow-Credentials", "true")
+    for k, v in headers.items():
+        handler.send_header(k, v)
+    if coding is None:
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+        return
+    handler.send_header("Content-Encoding", coding)
+    if len(body) < COMPRESS_STREAM_BYTES or not handler.supports_streaming:
+        compressed = compress_body(body, coding)
+        handler.send_header("Content-Length", str(len(compressed)))
+        handler.end_headers()
+        handler.wfile.write(compressed)
+        return
+    stream_compressed(handler, body, coding)
+
+
+def stream_compressed(handler: BaseHTTPRequestHandler, body: bytes, coding: str):
+    chunked = handler.request_version == "HTTP/1.1" and handler.protocol_version == "HTTP/1.1"
+    if chunked:
+        handler.send_header("Transfer-Encoding", "chunked")
+    else:
+        # Длина заранее неизвестна: конец тела — закрытие соединения
+        handler.send_header("Connection", "close")
+        handler.close_connection = True
+    handler.end_headers()
+    comp = compressor(coding)
+
+    def write(data: bytes):
+        if not data:
+            return
+        if chunked:
+            handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        else:
+            handler.wfile.write(data)
+
+    view = memoryview(body)
+    for offset in range(0, len(body), COMPRESS_CHUNK_BYTES):
+        write(comp.compress(view[offset:offset + COMPRESS_CHUNK_BYTES]))
+    write(comp.flush())
+    if chunked:
+        handler.wfile.write(b"0\r\n\r\n")
+
+
+def json_response(handler: BaseHTTPRequestHandler, status: int, payload: dict, extra_headers=None):
+    started = time.perf_counter()
+    body = json.dumps(payload).encode()
+    add_phase_time("serialize", time.perf_counter() - started)
+    bytes_response(handler, status, body, extra_headers)
+
+
+def accepted_encodings(handler: BaseHTTPRequestHandler) -> dict:
+    """Accept-Encoding в виде {coding: q}."""
+    result = {}
+    for part in (handler.headers.get("Accept-Encoding") or "").split(","):
+        coding, *params = [item.strip() for item in part.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        result[coding.lower()] = q
+    return result
+
+
+class BlogCache:
+    """Готовый ответ /api/blog: JSON, его gzip- и deflate-версии и валидаторы для 304.
+
+    Сбрасывается при любом изменении заметок в этом процессе; TTL ограничивает
+    устаревание, когда заметку меняет другой процесс (prefork).
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entry = None
+        self.generation = 0
+        self.etag = None
+        self.last_modified = 0
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.entry = None
+
+    def get(self):
+        with self.lock:
+            entry = self.entry
+            generation = self.generation
+        if entry is not None and entry["expires"] > time.monotonic():
+            return entry
+        body = json.dumps({"notes": load_blog_notes()}).encode()
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        with self.lock:
+            if etag != self.etag:
+                # Last-Modified двигается только при реальном изменении содержимого
+                self.etag = etag
+                self.last_modified = int(time.time())
+            entry = {
+                "body": body,
+                "gzip": gzip.compress(body, 6),
+                "deflate": compress_body(body, "deflate", 6),
+                "etag": etag,
+                "last_modified": email.utils.formatdate(self.last_modified, usegmt=True),
+                "modified_ts": self.last_modified,
+                "expires": time.monotonic() + self.ttl,
+            }
+            if generation == self.generation:
+                self.entry = entry
+        return entry
+
+
+BLOG_CACHE = BlogCache(BLOG_CACHE_TTL)
+
+
+def load_blog_notes() -> list:
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT notes.id, notes.title, notes.content_md, notes.updated_at, users.email AS author_email "
+        "FROM notes JOIN users ON users.id = notes.user_id WHERE notes.published = 1 "
+        "ORDER BY notes.updated_at DESC LIMIT 100"
+    ).fetchall()
+    conn.close()
+    return [
+        {
+            "id": row["id"],
+            "title": row["title"],
+            "content_md": row["content_md"],
+            "updated_at": row["updated_at"],
+            "author_email": row["author_email"],
+        }
+        for row in rows
+    ]
+
+
+def not_modified(handler: BaseHTTPRequestHandler, etag: str, modified_ts: int) -> bool:
+    if_none_match = handler.headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = handler.headers.get("If-Modified-Since")
+    if if_modified_since:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return modified_ts <= since
+    return False
+
+
+def parse_range(header: str, size: int):
+    """Один диапазон bytes=a-b / a- / -n → (start, end) включительно.
+
+    None — заголовок игнорируется (несколько диапазонов, чужие единицы),
+    ValueError — диапазон вне файла (416).
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None
+    if not first:
+        if int(last) == 0:
+            raise ValueError("unsatisfiable")
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size:
+        raise ValueError("unsatisfiable")
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def session_cookie(token: str, max_age: int = None) -> str:
+    max_age_attr = "" if max_age is None else f"; Max-Age={max_age}"
+    return f"session={token}; Path=/{max_age_attr}; HttpOnly; SameSite=Lax"
+
+
+def get_session_token(handler: BaseHTTPRequestHandler):
+    cookie_header = handler.headers.get("Cookie")
+    if not cookie_header:
+        return None
+    for part in cookie_header.split(';'):
+        if '=' not in part:
+            continue
+        name, value = part.strip().split('=', 1)
+        if name == 'session':
+            return value
+    return None
+
+
+class SessionCache:
+    """LRU-кэш сессий по токену: строка sessions JOIN users и расшифрованный профиль."""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None or entry[2] <= now:
+                if entry is not None:
+                    del self.entries[token]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return entry
+
+    def put(self, row, user: dict, expires_at: int, generation: int):
+        if self.size <= 0:
+            return
+        deadline = min(time.time() + self.ttl, expires_at)
+        with self.lock:
+            # Пока строка читалась из БД, сессию могли сбросить — такую не кладём
+            if generation != self.generation:
+                return
+            self.entries[row[0]] = (row, user, deadline)
+            self.entries.move_to_end(row[0])
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def cached_user(self, token: str):
+        with self.lock:
+            entry = self.entries.get(token)
+        return entry[1] if entry is not None else None
+
+    def invalidate_token(self, token: str):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(token, None)
+
+    def invalidate_user(self, user_id: int):
+        with self.lock:
+            self.generation += 1
+            for token in [t for t, entry in self.entries.items() if entry[0][1] == user_id]:
+                del self.entries[token]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": len(self.entries), "capacity": self.size, "hits": self.hits, "misses": self.misses}
+
+
+SESSION_CACHE = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+def build_user(session) -> dict:
+    return {
+        "nickname": session[3],
+        "email": session[2],
+        "full_name": decrypt_field(session[4]) if session[4] else None,
+        "phone": decrypt_field(session[5]) if session[5] else None,
+        "password_manager_url": decrypt_field(session[6]) if session[6] else None,
+        "is_admin": bool(session[7]),
+    }
+
+
+def session_user(session) -> dict:
+    user = SESSION_CACHE.cached_user(session[0])
+    if user is not None:
+        return user
+    return build_user(session)
+
+
+def with_session(handler: BaseHTTPRequestHandler):
+    token = get_session_token(handler)
+    if not token:
+        return None
+    entry = SESSION_CACHE.get(token)
+    if entry is not None:
+        return entry[0]
+    generation = SESSION_CACHE.generation
+    conn = get_conn()
+    now = int(time.time())
+    row = conn.execute(
+        "SELECT sessions.token, sessions.user_id, users.email, users.nickname, users.full_name, users.phone, users.password_manager_url, users.is_admin, sessions.expires_at "
+        "FROM sessions JOIN users ON users.id = sessions.user_id WHERE sessions.token = ? AND sessions.expires_at > ?",
+        (token, now),
+    ).fetchone()
+    conn.close()
+    if row:
+        SESSION_CACHE.put(row, build_user(row), row[8], generation)
+    return row
 
-        if parsed.path == "/api/notes":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
-            conn = get_conn()
-            rows = conn.execute(
-                "SELECT id, title, content_md, published, created_at, updated_at FROM notes WHERE user_id = ? ORDER BY updated_at DESC",
-                (session[1],),
-            ).fetchall()
-            conn.close()
-            notes = [dict(row) for row in rows]
-            json_response(self, 200, {"notes": notes})
-            return
 
-        if parsed.path.startswith("/api/notes/"):
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
-            try:
-                note_id = int(parsed.path.split("/")[-1])
-            except ValueError:
-                json_response(self, 400, {"error": "invalid_id"})
-                return
-            conn = get_conn()
-            row = conn.execute(
-                "SELECT id, title, content_md, published, created_at, updated_at FROM notes WHERE id = ? AND user_id = ?",
-                (note_id, session[1]),
-            ).fetchone()
-            conn.close()
-            if not row:
-                json_response(self, 404, {"error": "not_found"})
-                return
-            json_response(self, 200, {"note": dict(row)})
-            return
+def sweep_expired_sessions(batch: int = SESSION_SWEEP_BATCH) -> int:
+    """Удаляет истёкшие сессии пачками, чтобы не держать долгую блокировку записи."""
+    removed = 0
+    now = int(time.time())
+    conn = get_conn()
+    try:
+        while True:
+            cursor = conn.execute(
+                "DELETE FROM sessions WHERE token IN "
+                "(SELECT token FROM sessions WHERE expires_at <= ? LIMIT ?)",
+                (now, batch),
+            )
+            conn.commit()
+            removed += cursor.rowcount
+            if cursor.rowcount < batch:
+                return removed
+    finally:
+        conn.close()
 
-        if parsed.path == "/api/passwords":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
-            conn = get_conn()
-            rows = conn.execute(
-                "SELECT id, title, login_enc, password_enc, url_enc, notes_enc, created_at, updated_at FROM password_items WHERE user_id = ? ORDER BY updated_at DESC",
-                (session[1],),
-            ).fetchall()
-            conn.close()
-            items = []
-            for row in rows:
-                items.append(
-                    {
-                        "id": row["id"],
-                        "title": row["title"],
-                        "login": simple_decrypt(row["login_enc"]) if row["login_enc"] else "",
-                        "password": simple_decrypt(row["password_enc"]) if row["password_enc"] else "",
-                        "url": simple_decrypt(row["url_enc"]) if row["url_enc"] else "",
-                        "notes": simple_decrypt(row["notes_enc"]) if row["notes_enc"] else "",
-                        "created_at": row["created_at"],
-                        "updated_at": row["updated_at"],
-                    }
-                )
-            json_response(self, 200, {"items": items})
-            return
 
-        if parsed.path == "/api/admin/users":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
-            conn = get_conn()
-            rows = conn.execute(
-                "SELECT id, nickname, email, is_admin, created_at FROM users ORDER BY created_at DESC"
-            ).fetchall()
-            conn.close()
-            users = [
-                {
-                    "id": row["id"],
-                    "nickname": row["nickname"],
-                    "email": row["email"],
-                    "is_admin": bool(row["is_admin"]),
-                    "created_at": row["created_at"],
-                }
-                for row in rows
-            ]
-            json_response(self, 200, {"users": users})
-            return
+def start_periodic(name: str, interval: float, task, errors=(Exception,)):
+    if interval <= 0:
+        return None
 
-        if parsed.path == "/api/files":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
-            qs = parse_qs(parsed.query)
-            rel = qs.get("path", [""])[0]
+    def loop():
+        while True:
             try:
-                target = resolve_path(rel)
-            except ValueError:
-                json_response(self, 400, {"error": "invalid_path"})
-                return
-            entries = []
-            if os.path.exists(target):
-                for entry in os.scandir(target):
-                    info = entry.stat()
-                    entries.append(
-                        {
-                            "name": entry.name,
-                            "is_dir": entry.is_dir(),
-                            "size": info.st_size,
-                            "modified": int(info.st_mtime),
-                        }
-                    )
-            json_response(self, 200, {"path": rel, "entries": entries})
-            return
-
-        if parsed.path == "/api/blog":
-            conn = get_conn()
-            rows = conn.execute(
-                "SELECT notes.id, notes.title, notes.content_md, notes.updated_at, users.email AS author_email "
-                "FROM notes JOIN users ON users.id = notes.user_id WHERE notes.published = 1 "
-                "ORDER BY notes.updated_at DESC LIMIT 100"
-            ).fetchall()
-            conn.close()
-            notes = [
-                {
-                    "id": row["id"],
-                    "title": row["title"],
-                    "content_md": row["content_md"],
-                    "updated_at": row["updated_at"],
-                    "author_email": row["author_email"],
-                }
-                for row in rows
-            ]
-            json_response(self, 200, {"notes": notes})
+                task()
+            except errors:
+                # БД занята или диск недоступен — попробуем в следующий раз
+                pass
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def compact_tombstones(ttl: float = SYNC_TOMBSTONE_TTL) -> int:
+    """Удаляет tombstones старше ttl и поднимает горизонт: клиенты с since ниже получат полную выборку."""
+    cutoff = int(time.time() - ttl)
+    conn = get_conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        horizon = conn.execute("SELECT MAX(seq) FROM sync_tombstones WHERE deleted_at < ?", (cutoff,)).fetchone()[0]
+        if horizon is None:
+            conn.rollback()
+            return 0
+        cursor = conn.execute("DELETE FROM sync_tombstones WHERE seq <= ?", (horizon,))
+        conn.execute("UPDATE sync_counters SET value = MAX(value, ?) WHERE name = 'compacted'", (horizon,))
+        conn.commit()
+        return cursor.rowcount
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def start_background_tasks():
+    start_periodic("session-sweeper", SESSION_SWEEP_INTERVAL, sweep_expired_sessions, (sqlite3.Error,))
+    start_periodic("upload-sweeper", UPLOAD_SWEEP_INTERVAL, sweep_stale_uploads, (OSError,))
+    start_periodic("tombstone-compactor", SYNC_COMPACT_INTERVAL, compact_tombstones, (sqlite3.Error,))
+
+
+def trim_user_sessions(conn, user_id: int) -> int:
+    """Оставляет пользователю не больше SESSION_MAX_PER_USER самых свежих сессий."""
+    if SESSION_MAX_PER_USER <= 0:
+        return 0
+    cursor = conn.execute(
+        "DELETE FROM sessions WHERE user_id = ? AND token NOT IN "
+        "(SELECT token FROM sessions WHERE user_id = ? ORDER BY created_at DESC LIMIT ?)",
+        (user_id, user_id, SESSION_MAX_PER_USER),
+    )
+    return cursor.rowcount
+
+
+def is_admin(session) -> bool:
+    return bool(session and len(session) > 7 and session[7])
+
+
+class EventSubscriber:
+    def __init__(self, user_id: int, admin: bool, threaded: bool):
+        self.user_id = user_id
+        self.admin = admin
+        self.threaded = threaded
+        self.pending = deque()
+        self.closed = False
+        self.ready = threading.Event()
+        # asyncio-движок подменяет на call_soon_threadsafe своего asyncio.Event
+        self.wake = self.ready.set
+
+    def wants(self, event: tuple) -> bool:
+        user_id = event[2]
+        return self.admin if user_id is None else user_id == self.user_id
+
+
+class EventBus:
+    """Pub/sub внутри процесса для GET /api/events.
+
+    Событие — (номер, тип, user_id, JSON); user_id None — для всех администраторов.
+    Последние history событий хранятся для Last-Event-ID. У подписчика своя очередь
+    на max_pending событий: переполнил — не успевает читать, его отключают, а
+    клиент переподключится и догонит по Last-Event-ID. В prefork у каждого процесса
+    своя шина: события из других процессов клиент получит при следующей синхронизации.
+    """
+
+    def __init__(self, history: int, max_pending: int, max_subscribers: int, max_threads: int):
+        self.lock = threading.Lock()
+        # Номера событий не переживают перезапуск: чужой boot в Last-Event-ID — reset
+        self.boot = secrets.token_hex(4)
+        self.last_id = 0
+        self.history = deque(maxlen=max(1, history))
+        self.subscribers = set()
+        self.max_pending = max_pending
+        self.max_subscribers = max_subscribers
+        self.max_threads = max_threads
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, topic: str, data: dict, user_id: int = None):
+        with self.lock:
+            self.last_id += 1
+            event = (self.last_id, topic, user_id, json.dumps(data, ensure_ascii=False))
+            self.history.append(event)
+            self.published += 1
+            for subscriber in list(self.subscribers):
+                if not subscriber.wants(event):
+                    continue
+                if len(subscriber.pending) >= self.max_pending:
+                    self.subscribers.discard(subscriber)
+                    subscriber.closed = True
+                    self.dropped += 1
+                else:
+                    subscriber.pending.append(event)
+                subscriber.wake()
+
+    def replay(self, last_event_id: str):
+        """События после last_event_id; None — их уже нет в истории (или другой запуск)."""
+        boot, _, number = last_event_id.partition("-")
+        if boot != self.boot or not number.isdigit():
+            return None
+        number = int(number)
+        oldest = self.history[0][0] if self.history else self.last_id + 1
+        if number > self.last_id or number < oldest - 1:
+            return None
+        return [event for event in self.history if event[0] > number]
+
+    def subscribe(self, user_id: int, admin: bool, threaded: bool, last_event_id: str = None) -> EventSubscriber:
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                raise ApiError(503, "too_many_subscribers")
+            if threaded and sum(1 for s in self.subscribers if s.threaded) >= self.max_threads:
+                raise ApiError(503, "too_many_subscribers")
+            subscriber = EventSubscriber(user_id, admin, threaded)
+            if last_event_id:
+                events = self.replay(last_event_id)
+                if events is not None:
+                    events = [event for event in events if subscriber.wants(event)]
+                if events is None or len(events) > self.max_pending:
+                    # Пропущенное не восстановить: клиент перечитывает данные целиком
+                    events = [(self.last_id, "reset", subscriber.user_id, "{}")]
+                subscriber.pending.extend(events)
+            self.subscribers.add(subscriber)
+            return subscriber
+
+    def take(self, subscriber: EventSubscriber):
+        """Накопленные события подписчика и признак, что поток пора закрыть."""
+        with self.lock:
+            events = list(subscriber.pending)
+            subscriber.pending.clear()
+            subscriber.ready.clear()
+            return events, subscriber.closed
+
+    def unsubscribe(self, subscriber: EventSubscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            subscriber.closed = True
+
+    def close_all(self):
+        """При остановке сервера: потоки событий завершаются, не дожидаясь EVENTS_MAX_AGE."""
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, set()
+            for subscriber in subscribers:
+                subscriber.closed = True
+                subscriber.wake()
+
+    def format(self, event: tuple) -> bytes:
+        number, topic, _, data = event
+        return f"id: {self.boot}-{number}\nevent: {topic}\ndata: {data}\n\n".encode()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "subscribers": len(self.subscribers),
+                "published": self.published,
+                "dropped": self.dropped,
+            }
+
+
+EVENT_BUS = EventBus(EVENTS_HISTORY, EVENTS_MAX_PENDING, EVENTS_MAX_SUBSCRIBERS, EVENTS_MAX_THREADS)
+# События этих типов общие для всех администраторов, остальные — только своему пользователю
+ADMIN_EVENT_TOPICS = ("files", "users")
+
+
+class Route:
+    def __init__(self, method: str, template: str, handler, auth: str, events: tuple = (), body: str = "json"):
+        self.method = method
+        self.template = template
+        self.handler = handler
+        # public — без сессии, user — любая сессия, admin — сессия администратора
+        self.auth = auth
+        # Типы событий /api/events, которые маршрут публикует после успешного ответа
+        self.events = events
+        # Вид тела из BODY_LIMITS: лимит буфера asyncio-движка
+        self.body = body
+        self.name = handler.__name__
+        self.call = None
+
+
+class Router:
+    """Таблица маршрутов: метод + шаблон пути → обработчик.
+
+    Статические пути ищутся в словаре, пути с параметрами (`/api/notes/<int:note_id>`) —
+    по дереву сегментов, так что число маршрутов не удлиняет разбор запроса.
+    Middleware оборачивают обработчик один раз при регистрации, а не на каждом запросе.
+    """
+
+    # Конвертер параметра и код ошибки 400, если сегмент не подходит
+    converters = {"int": (int, "invalid_id"), "str": (str, None)}
+
+    def __init__(self):
+        self.routes = []
+        self.static = {}
+        self.tree = {"static": {}, "param": None, "routes": {}}
+        self.middleware = []
+
+    def route(self, method: str, template: str, auth: str = "admin", events: tuple = (), body: str = "json"):
+        def register(handler):
+            self.add(method, template, handler, auth, events, body)
+            return handler
+
+        return register
+
+    def add(
+        self, method: str, template: str, handler, auth: str = "admin", events: tuple = (), body: str = "json"
+    ):
+        if auth not in ("public", "user", "admin"):
+            raise ValueError(f"unknown auth level: {auth}")
+        if body not in BODY_LIMITS:
+            raise ValueError(f"unknown body kind: {body}")
+        route = Route(method, template, handler, auth, events, body)
+        route.call = self.compose(route)
+        segments = template.strip("/").split("/")
+        if not any(segment.startswith("<") for segment in segments):
+            self.static[(method, template)] = route
+        else:
+            node = self.tree
+            for segment in segments:
+                if segment.startswith("<"):
+                    converter, _, name = segment[1:-1].rpartition(":")
+                    converter = converter or "str"
+                    if converter not in self.converters:
+                        raise ValueError(f"unknown converter in {template}")
+                    if node["param"] is None:
+                        node["param"] = (name, converter, {"static": {}, "param": None, "routes": {}})
+                    elif node["param"][:2] != (name, converter):
+                        raise ValueError(f"conflicting parameter in {template}")
+                    node = node["param"][2]
+                else:
+                    node = node["static"].setdefault(segment, {"static": {}, "param": None, "routes": {}})
+            if method in node["routes"]:
+                raise ValueError(f"duplicate route {method} {template}")
+            node["routes"][method] = route
+        self.routes.append(route)
+        return route
+
+    def use(self, middleware):
+        """Добавляет middleware(handler, route, params, call_next) внутрь уже подключённых."""
+        self.middleware.append(middleware)
+        for route in self.routes:
+            route.call = self.compose(route)
+
+    def compose(self, route: Route):
+        def call(handler, params):
+            route.handler(handler, **params)
+
+        for middleware in reversed(self.middleware):
+            call = self.wrap(middleware, route, call)
+        return call
+
+    @staticmethod
+    def wrap(middleware, route: Route, inner):
+        def call(handler, params):
+            middleware(handler, route, params, lambda: inner(handler, params))
+
+        return call
+
+    def resolve(self, method: str, path: str):
+        """(маршрут, параметры) или (None, {}). ApiError(400), если параметр не конвертируется."""
+        route = self.static.get((method, path))
+        if route is not None:
+            return route, {}
+        node = self.tree
+        params = {}
+        for segment in path.strip("/").split("/"):
+            child = node["static"].get(segment)
+            if child is None:
+                if node["param"] is None:
+                    return None, {}
+                name, converter, child = node["param"]
+                convert, error = self.converters[converter]
+                try:
+                    params[name] = convert(segment)
+                except ValueError:
+                    raise ApiError(400, error)
+            node = child
+        route = node["routes"].get(method)
+        return (route, params) if route is not None else (None, {})
+
+
+ROUTER = Router()
+
+
+def error_middleware(handler, route: Route, params: dict, call_next):
+    try:
+        call_next()
+    except ApiError as exc:
+        if handler.response_status is None:
+            json_response(handler, exc.status, {"error": exc.code})
+        else:
+            handler.close_connection = True
+    except Exception:
+        traceback.print_exc()
+        if handler.response_status is None:
+            json_response(handler, 500, {"error": "internal_error"})
+        else:
+            # Ответ уже начат — дописать его корректно нельзя
+            handler.close_connection = True
+
+
+def metrics_middleware(handler, route: Route, params: dict, call_next):
+    key = (route.method, route.template)
+    phases = dict.fromkeys(METRICS_PHASES, 0.0)
+    REQUEST_PHASES.current = phases
+    REQUEST_PHASES.active = False
+    METRICS.start(key)
+    started = time.perf_counter()
+    try:
+        call_next()
+    finally:
+        REQUEST_PHASES.current = None
+        METRICS.finish(key, handler.response_status or 0, time.perf_counter() - started, phases)
+
+
+def auth_middleware(handler, route: Route, params: dict, call_next):
+    if route.auth != "public":
+        session = with_session(handler)
+        if not session:
+            json_response(handler, 401, {"error": "auth_required"})
+            return
+        if route.auth == "admin" and not is_admin(session):
+            json_response(handler, 403, {"error": "admin_only"})
             return
+        handler.session = session
+    call_next()
 
-        json_response(self, 404, {"error": "not_found"})
 
-    def do_POST(self):  # noqa: N802
-        parsed = urlparse(self.path)
-        if parsed.path == "/api/register":
-            json_response(self, 403, {"error": "registration_disabled"})
+def events_middleware(handler, route: Route, params: dict, call_next):
+    call_next()
+    if not route.events or handler.response_status is None or handler.response_status >= 400:
+        return
+    data = {"method": route.method, **params}
+    path = parse_qs(handler.query).get("path")
+    if path:
+        data["path"] = path[0]
+    for topic in route.events:
+        EVENT_BUS.publish(topic, data, None if topic in ADMIN_EVENT_TOPICS else handler.session[1])
+
+
+# Снаружи внутрь: метрики видят итоговый статус, в том числе ответ error_middleware
+ROUTER.use(metrics_middleware)
+ROUTER.use(error_middleware)
+ROUTER.use(auth_middleware)
+ROUTER.use(events_middleware)
+
+
+def metrics_gauges() -> list:
+    pool = DB_POOL.stats()
+    sessions = SESSION_CACHE.stats()
+    dirs = DIR_CACHE.stats()
+    return [
+        ("db_pool_connections", "gauge", "SQLite connections in the pool.",
+         [({"state": "idle"}, pool["idle"]), ({"state": "in_use"}, pool["in_use"])]),
+        ("db_pool_connections_created_total", "counter", "SQLite connections opened.", [(None, pool["created"])]),
+        ("db_pool_acquires_total", "counter", "Connections taken from the pool.", [(None, pool["acquires"])]),
+        ("password_hasher_in_flight", "gauge", "scrypt computations running or queued.",
+         [(None, PASSWORD_HASHER.in_flight)]),
+        ("password_hasher_rejected_total", "counter", "scrypt requests rejected with 503.",
+         [(None, PASSWORD_HASHER.rejected)]),
+        ("cache_hits_total", "counter", "In-process cache hits.",
+         [({"cache": "session"}, sessions["hits"]), ({"cache": "dir"}, dirs["hits"])]),
+        ("cache_misses_total", "counter", "In-process cache misses.",
+         [({"cache": "session"}, sessions["misses"]), ({"cache": "dir"}, dirs["misses"])]),
+        ("process_start_time_seconds", "gauge", "Start time of the process.", [(None, f"{PROCESS_STARTED_AT:.3f}")]),
+    ]
+
+
+class AppHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # StreamRequestHandler ставит его на сокет: простой между запросами и внутри запроса
+    timeout = KEEPALIVE_TIMEOUT
+    # Заголовки и тело уходят разными send(): с Nagle на keep-alive
+    # второй ждал бы delayed ACK клиента (~40 мс)
+    disable_nagle_algorithm = True
+    # Можно ли писать тело частями прямо в сокет (см. stream_compressed)
+    supports_streaming = True
+    # Лимиты keep-alive соединения; asyncio-движок ведёт соединения сам
+    keep_alive_limits = True
+    requests_handled = 0
+    body_pending = 0
+
+    def log_message(self, format, *args):  # noqa: N802
+        # Тише в контейнере
+        return
+
+    def do_OPTIONS(self):  # noqa: N802
+        self.send_response(204)
+        self.send_header("Access-Control-Allow-Origin", FRONTEND_ORIGIN)
+        self.send_header("Access-Control-Allow-Credentials", "true")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type, If-Match, X-Upload-Id, X-Chunk-Sha256")
+        self.send_header("Access-Control-Allow-Methods", "GET,POST,PUT,PATCH,DELETE,OPTIONS")
+        self.end_headers()
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
+        if not self.keep_alive_limits:
             return
+        self.requests_handled += 1
+        if (
+            self.close_connection
+            or self.body_pending > JSON_MAX_BYTES
+            or self.requests_handled >= KEEPALIVE_MAX_REQUESTS
+            or self.server_is_busy()
+        ):
+            # Непрочитанное тело больше JSON_MAX_BYTES discard_body не дочитает — решаем до заголовков
+            # send_header("Connection", "close") сам выставляет close_connection
+            self.send_header("Connection", "close")
+        else:
+            remaining = KEEPALIVE_MAX_REQUESTS - self.requests_handled
+            self.send_header("Keep-Alive", f"timeout={int(KEEPALIVE_TIMEOUT)}, max={remaining}")
 
-        if parsed.path == "/api/login":
-            data = parse_json(self)
-            email = (data.get("email") or "").strip().lower()
-            password = data.get("password") or ""
-            conn = get_conn()
-            row = conn.execute(
-                "SELECT id, password_hash FROM users WHERE email = ?",
-                (email,),
-            ).fetchone()
-            if not row or not verify_password(password, row[1]):
-                conn.close()
-                json_response(self, 401, {"error": "invalid_credentials"})
-                return
-            token = base64.urlsafe_b64encode(secrets.token_bytes(32)).decode()
-            expires = int(time.time()) + 7 * 24 * 3600
-            conn.execute(
-                "INSERT OR REPLACE INTO sessions (token, user_id, expires_at, created_at) VALUES (?, ?, ?, ?)",
-                (token, row[0], expires, int(time.time())),
-            )
-            conn.commit()
-            conn.close()
-            self.send_response(200)
-            set_session_cookie(self, token)
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.send_header("Access-Control-Allow-Origin", FRONTEND_ORIGIN)
-            self.send_header("Access-Control-Allow-Credentials", "true")
-            self.end_headers()
-            self.wfile.write(json.dumps({"ok": True}).encode())
-            return
-
-        if parsed.path == "/api/logout":
-            token = get_session_token(self)
-            if token:
-                conn = get_conn()
-                conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
-                conn.commit()
-                conn.close()
-            self.send_response(200)
-            self.send_header("Set-Cookie", "session=; Path=/; Max-Age=0; HttpOnly; SameSite=Lax")
-            self.send_header("Access-Control-Allow-Origin", FRONTEND_ORIGIN)
-            self.send_header("Access-Control-Allow-Credentials", "true")
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps({"ok": True}).encode())
+    def server_is_busy(self) -> bool:
+        """Есть ли соединения, которым нужен поток, занятый этим keep-alive."""
+        jobs = getattr(self.server, "jobs", None)
+        # Однопоточный HTTPServer: пока держим соединение, остальные клиенты ждут
+        return jobs is None or not jobs.empty()
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self) -> bool:
+        """Простой между запросами keep-alive. False — закрыть: истёк таймаут или поток нужен очереди.
+
+        Поток спит в select на сокете и на wakeup-канале сервера: новое соединение в очереди
+        будит ждущих, и один из них освобождает поток.
+        """
+        # Конвейерный запрос мог уже оказаться в буфере rfile — select его не увидит
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except BlockingIOError:
+            pass
+        finally:
+            self.connection.settimeout(self.timeout)
+        server = self.server
+        wakeup = getattr(server, "wakeup_r", None)
+        if wakeup is None:
+            # Однопоточный HTTPServer: соединение уже закрыто ответом с Connection: close
+            return False
+        # Сначала встать в ждущие, потом проверить очередь: так соединение, принятое
+        # между проверкой и select, либо видно в очереди, либо разбудит через канал
+        with server.waiting_lock:
+            server.waiting += 1
+        try:
+            if self.server_is_busy() or server.closing:
+                return False
+            deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                readable, _, _ = select.select([self.connection, wakeup], [], [], remaining)
+                if self.connection in readable:
+                    return True
+                if wakeup in readable:
+                    try:
+                        os.read(wakeup, 1)
+                    except BlockingIOError:
+                        # Сигнал забрал другой ждущий поток
+                        continue
+                    if self.server_is_busy() or server.closing:
+                        return False
+        finally:
+            with server.waiting_lock:
+                server.waiting -= 1
+
+    def request_body_length(self) -> int:
+        """Сколько байт тела ещё в сокете; chunked-тела этот обработчик не разбирает."""
+        encoding = (self.headers.get("Transfer-Encoding") or "identity").lower()
+        if encoding != "identity":
+            self.close_connection = True
+            return 0
+        try:
+            return max(0, int(self.headers.get("Content-Length") or 0))
+        except ValueError:
+            self.close_connection = True
+            return 0
+
+    def discard_body(self):
+        """Дочитывает тело, которое маршрут не прочитал (401, 404...), чтобы соединение осталось рабочим.
+
+        Тело больше JSON_MAX_BYTES не читается: ответ на него уже ушёл с Connection: close (send_response).
+        """
+        if not self.body_pending or self.close_connection:
             return
+        if self.body_pending > JSON_MAX_BYTES:
+            self.close_connection = True
+            return
+        self.rfile.read(self.body_pending)
+        self.body_pending = 0
 
-        if parsed.path == "/api/admin/users":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
-            data = parse_json(self)
-            nickname = (data.get("nickname") or "").strip()
-            email = (data.get("email") or "").strip().lower()
-            password = data.get("password") or ""
-            make_admin = 1 if data.get("is_admin") else 0
-            if not email or not password or not nickname:
-                json_response(self, 400, {"error": "nickname_email_and_password_required"})
-                return
-            conn = get_conn()
-            try:
-                conn.execute(
-                    "INSERT INTO users (nickname, email, password_hash, is_admin, created_at) VALUES (?, ?, ?, ?, ?)",
-                    (nickname, email, hash_password(password), make_admin, int(time.time())),
-                )
-                conn.commit()
-            except sqlite3.IntegrityError:
-                conn.close()
-                json_response(self, 409, {"error": "email_exists"})
-                return
-            conn.close()
-            json_response(self, 201, {"ok": True})
+    def handle_route(self):
+        parsed = urlparse(self.path)
+        self.query = parsed.query
+        self.session = None
+        self.response_status = None
+        self.body_pending = self.request_body_length()
+        try:
+            self.dispatch_route(parsed.path)
+        finally:
+            self.discard_body()
+
+    def dispatch_route(self, path: str):
+        try:
+            route, params = ROUTER.resolve(self.command, path)
+        except ApiError as exc:
+            json_response(self, exc.status, {"error": exc.code})
+            METRICS.finish((self.command, "unmatched"), exc.status, 0.0)
+            return
+        if route is None:
+            json_response(self, 404, {"error": "not_found"})
+            # Неизвестные пути — одной меткой, чтобы сканеры не раздували число рядов
+            METRICS.finish((self.command, "unmatched"), 404, 0.0)
             return
+        route.call(self, params)
 
-        if parsed.path == "/api/files/upload":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
-            data = parse_json(self)
-            rel_path = data.get("path") or ""
-            name = data.get("name") or ""
-            content_b64 = data.get("content_base64") or ""
-            if not name or not content_b64:
-                json_response(self, 400, {"error": "name_and_content_required"})
-                return
-            try:
-                target_dir = resolve_path(rel_path)
-                os.makedirs(target_dir, exist_ok=True)
-                content = base64.b64decode(content_b64.encode())
-                dest = resolve_path(os.path.join(rel_path, name))
-                if os.path.isdir(dest):
-                    json_response(self, 400, {"error": "path_is_directory"})
-                    return
-                with open(dest, "wb") as f:
-                    f.write(content)
-                json_response(self, 201, {"ok": True})
-            except ValueError:
-                json_response(self, 400, {"error": "invalid_path"})
-            except Exception:
-                json_response(self, 500, {"error": "write_failed"})
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_route  # noqa: N815
+
+    @ROUTER.route("GET", "/api/health", auth="public")
+    def health(self):
+        json_response(self, 200, {"status": "ok"})
+
+    @ROUTER.route("GET", "/api/me", auth="user")
+    def get_me(self):
+        json_response(self, 200, {"user": session_user(self.session)})
+
+    @ROUTER.route("GET", "/api/notes")
+    def list_notes(self):
+        try:
+            params = parse_list_query(self.query, NOTE_FIELDS)
+        except ValueError as exc:
+            json_response(self, 400, {"error": str(exc)})
             return
+        conn = get_conn()
+        rows, next_cursor = fetch_page(conn, "notes", params["fields"], self.session[1], params)
+        conn.close()
+        notes = [{field: row[field] for field in params["fields"]} for row in rows]
+        json_response(self, 200, {"notes": notes, "next_cursor": next_cursor})
 
-        if parsed.path == "/api/files/folder":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
-            data = parse_json(self)
-            rel_path = data.get("path") or ""
-            name = (data.get("name") or "").strip()
-            if not name:
-                json_response(self, 400, {"error": "name_required"})
-                return
-            try:
-                target = resolve_path(os.path.join(rel_path, name))
-                os.makedirs(target, exist_ok=True)
-                json_response(self, 201, {"ok": True})
-            except ValueError:
-                json_response(self, 400, {"error": "invalid_path"})
-            except Exception:
-                json_response(self, 500, {"error": "mkdir_failed"})
+    @ROUTER.route("GET", "/api/notes/search")
+    def search_own_notes(self):
+        self.search_response(self.query, user_id=self.session[1])
+
+    @ROUTER.route("GET", "/api/notes/<int:note_id>")
+    def get_note(self, note_id: int):
+        conn = get_conn()
+        row = conn.execute(
+            "SELECT id, title, content_md, published, created_at, updated_at, seq FROM notes WHERE id = ? AND user_id = ?",
+            (note_id, self.session[1]),
+        ).fetchone()
+        conn.close()
+        if not row:
+            json_response(self, 404, {"error": "not_found"})
             return
+        note = dict(row)
+        note["version"] = note.pop("seq")
+        json_response(self, 200, {"note": note}, {"ETag": f'"{note["version"]}"'})
 
-        if parsed.path == "/api/notes":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
-            data = parse_json(self)
-            title = (data.get("title") or "").strip()
-            content = data.get("content") or ""
-            published = 1 if data.get("published") else 0
-            if not title:
-                json_response(self, 400, {"error": "title_required"})
-                return
-            now = int(time.time())
-            conn = get_conn()
-            conn.execute(
-                "INSERT INTO notes (user_id, title, content_md, published, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (session[1], title, content, published, now, now),
-            )
-            conn.commit()
+    @ROUTER.route("GET", "/api/notes/<int:note_id>/revisions")
+    def list_note_revisions(self, note_id: int):
+        conn = get_conn()
+        note = conn.execute("SELECT seq FROM notes WHERE id = ? AND user_id = ?", (note_id, self.session[1])).fetchone()
+        if not note:
             conn.close()
-            json_response(self, 201, {"ok": True})
+            json_response(self, 404, {"error": "not_found"})
             return
+        rows = conn.execute(
+            "SELECT version, base_version IS NULL AS snapshot, length(data) AS size, created_at "
+            "FROM note_revisions WHERE note_id = ? ORDER BY version DESC",
+            (note_id,),
+        ).fetchall()
+        conn.close()
+        revisions = [{**dict(row), "snapshot": bool(row["snapshot"])} for row in rows]
+        json_response(self, 200, {"version": note["seq"], "revisions": revisions})
 
-        if parsed.path == "/api/passwords":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
-            data = parse_json(self)
-            title = (data.get("title") or "").strip()
-            login_val = (data.get("login") or "").strip()
-            password_val = data.get("password") or ""
-            url_val = clean_url(data.get("url"))
-            notes_val = data.get("notes") or ""
-            if not title or not password_val:
-                json_response(self, 400, {"error": "title_and_password_required"})
-                return
-            now = int(time.time())
-            conn = get_conn()
-            conn.execute(
-                "INSERT INTO password_items (user_id, title, login_enc, password_enc, url_enc, notes_enc, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (
-                    session[1],
-                    title,
-                    simple_encrypt(login_val) if login_val else None,
-                    simple_encrypt(password_val),
-                    simple_encrypt(url_val) if url_val else None,
-                    simple_encrypt(notes_val) if notes_val else None,
-                    now,
-                    now,
-                ),
-            )
-            conn.commit()
+    @ROUTER.route("GET", "/api/notes/<int:note_id>/revisions/<int:version>")
+    def get_note_revision(self, note_id: int, version: int):
+        conn = get_conn()
+        note = conn.execute(
+            "SELECT content_md, seq FROM notes WHERE id = ? AND user_id = ?", (note_id, self.session[1])
+        ).fetchone()
+        if not note:
             conn.close()
-            json_response(self, 201, {"ok": True})
+            json_response(self, 404, {"error": "not_found"})
+            return
+        text = note["content_md"] if version == note["seq"] else note_revision_text(conn, note_id, version)
+        conn.close()
+        if text is None:
+            json_response(self, 404, {"error": "revision_not_found"})
             return
+        json_response(self, 200, {"version": version, "content_md": text})
 
-        json_response(self, 404, {"error": "not_found"})
+    @ROUTER.route("GET", "/api/passwords")
+    def list_passwords(self):
+        try:
+            params = parse_list_query(self.query, PASSWORD_FIELDS)
+        except ValueError as exc:
+            json_response(self, 400, {"error": str(exc)})
+            return
+        columns = [PASSWORD_FIELDS[field] for field in params["fields"]]
+        conn = get_conn()
+        rows, next_cursor = fetch_page(conn, "password_items", columns, self.session[1], params)
+        conn.close()
+        # Расшифровываются только запрошенные поля
+        encrypted = [column for column in columns if column.endswith("_enc")]
+        plain = iter(decrypt_fields([row[column] for row in rows for column in encrypted]))
+        items = []
+        for row in rows:
+            item = {}
+            for field, column in zip(params["fields"], columns):
+                item[field] = next(plain) if column.endswith("_enc") else row[column]
+            items.append(item)
+        json_response(self, 200, {"items": items, "next_cursor": next_cursor})
 
-    def do_PUT(self):  # noqa: N802
-        parsed = urlparse(self.path)
-        if parsed.path == "/api/me":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            data = parse_json(self)
-            full_name = (data.get("full_name") or "").strip()
-            phone = (data.get("phone") or "").strip()
-            password_manager_url = clean_url(data.get("password_manager_url"))
-            conn = get_conn()
-            conn.execute(
-                "UPDATE users SET full_name = ?, phone = ?, password_manager_url = ? WHERE id = ?",
-                (
-                    simple_encrypt(full_name) if full_name else None,
-                    simple_encrypt(phone) if phone else None,
-                    simple_encrypt(password_manager_url) if password_manager_url else None,
-                    session[1],
-                ),
-            )
-            conn.commit()
+    @ROUTER.route("GET", "/api/sync")
+    def sync(self):
+        qs = parse_qs(self.query)
+        try:
+            since = int(qs.get("since", ["0"])[0])
+        except ValueError:
+            since = -1
+        if since < 0:
+            json_response(self, 400, {"error": "invalid_since"})
+            return
+        try:
+            limit = int(qs.get("limit", [str(PAGE_MAX_LIMIT)])[0])
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            json_response(self, 400, {"error": "invalid_limit"})
+            return
+        conn = get_conn()
+        try:
+            changes = sync_changes(conn, self.session[1], since, min(limit, PAGE_MAX_LIMIT))
+        finally:
             conn.close()
-            json_response(self, 200, {"ok": True})
+        json_response(self, 200, changes)
+
+    @ROUTER.route("GET", "/api/events", auth="user")
+    def events(self):
+        if self.supports_streaming and getattr(self.server, "jobs", None) is None:
+            # Однопоточный сервер: открытый поток событий остановил бы все остальные запросы
+            json_response(self, 503, {"error": "events_unavailable"})
             return
+        last_event_id = self.headers.get("Last-Event-ID") or parse_qs(self.query).get("last_event_id", [None])[0]
+        subscriber = EVENT_BUS.subscribe(
+            self.session[1], is_admin(self.session), self.supports_streaming, last_event_id
+        )
+        # Поток заканчивается только закрытием соединения
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("X-Accel-Buffering", "no")
+        if not self.keep_alive_limits:
+            # Потоковые режимы добавляют Connection: close в send_response сами
+            self.send_header("Connection", "close")
+        self.send_header("Access-Control-Allow-Origin", FRONTEND_ORIGIN)
+        self.send_header("Access-Control-Allow-Credentials", "true")
+        self.end_headers()
+        self.wfile.write(b"retry: 3000\n\n")
+        if not self.supports_streaming:
+            # asyncio-движок отдаёт события сам, не занимая поток (AsyncHTTPServer.stream_events)
+            self.pending_events = subscriber
+            return
+        deadline = time.monotonic() + EVENTS_MAX_AGE
+        try:
+            while time.monotonic() < deadline:
+                events, closed = EVENT_BUS.take(subscriber)
+                if closed:
+                    break
+                self.wfile.write(b"".join(map(EVENT_BUS.format, events)) if events else b": ping\n\n")
+                subscriber.ready.wait(min(EVENTS_HEARTBEAT, max(0.0, deadline - time.monotonic())))
+        except OSError:
+            # Клиент ушёл
+            pass
+        finally:
+            EVENT_BUS.unsubscribe(subscriber)
+
+    @ROUTER.route("GET", "/api/admin/users")
+    def list_users(self):
+        conn = get_conn()
+        rows = conn.execute(
+            "SELECT id, nickname, email, is_admin, created_at FROM users ORDER BY created_at DESC"
+        ).fetchall()
+        conn.close()
+        users = [
+            {
+                "id": row["id"],
+                "nickname": row["nickname"],
+                "email": row["email"],
+                "is_admin": bool(row["is_admin"]),
+                "created_at": row["created_at"],
+            }
+            for row in rows
+        ]
+        json_response(self, 200, {"users": users})
+
+    @ROUTER.route("GET", "/api/admin/stats")
+    def admin_stats(self):
+        stats = {
+            "session_cache": SESSION_CACHE.stats(),
+            "dir_cache": DIR_CACHE.stats(),
+            "blob_store": blob_store_stats(),
+            "routes": METRICS.summary(),
+            "events": EVENT_BUS.stats(),
+        }
+        json_response(self, 200, stats)
 
-        if parsed.path.startswith("/api/notes/"):
+    @ROUTER.route("GET", "/api/metrics", auth="public")
+    def metrics(self):
+        authorization = self.headers.get("Authorization") or ""
+        if not (METRICS_TOKEN and hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}")):
             session = with_session(self)
             if not session:
                 json_response(self, 401, {"error": "auth_required"})
@@ -662,170 +3430,1200 @@ class AppHandler(BaseHTTPRequestHandler):
             if not is_admin(session):
                 json_response(self, 403, {"error": "admin_only"})
                 return
+        body = METRICS.render(metrics_gauges()).encode()
+        bytes_response(self, 200, body, {"Cache-Control": "no-store"}, "text/plain; version=0.0.4; charset=utf-8")
+
+    @ROUTER.route("GET", "/api/files/uploads/<upload_id>")
+    def get_chunked_upload(self, upload_id: str):
+        try:
+            with locked_upload_meta(upload_id) as (_, meta):
+                status = upload_status(meta)
+        except UploadError as exc:
+            json_response(self, exc.status, {"error": exc.code})
+            return
+        json_response(self, 200, status)
+
+    @ROUTER.route("GET", "/api/files/upload/progress")
+    def upload_progress(self):
+        upload_id = parse_qs(self.query).get("id", [""])[0]
+        progress = UPLOAD_PROGRESS.get(upload_id)
+        if progress is None:
+            json_response(self, 404, {"error": "not_found"})
+            return
+        json_response(self, 200, {"id": upload_id, **progress})
+
+    @ROUTER.route("GET", "/api/files/download")
+    def download_file(self):
+        self.send_file(parse_qs(self.query).get("path", [""])[0])
+
+    @ROUTER.route("GET", "/api/files")
+    def list_files(self):
+        qs = parse_qs(self.query)
+        rel = qs.get("path", [""])[0]
+        try:
+            target = resolve_path(rel)
+        except ValueError:
+            json_response(self, 400, {"error": "invalid_path"})
+            return
+        sort = qs.get("sort", ["name"])[0]
+        if sort not in DIR_SORT_KEYS:
+            json_response(self, 400, {"error": "invalid_sort"})
+            return
+        descending = qs.get("order", ["asc"])[0] == "desc"
+        try:
+            offset = max(0, int(qs.get("offset", ["0"])[0]))
+            limit = int(qs["limit"][0]) if qs.get("limit") else None
+        except ValueError:
+            json_response(self, 400, {"error": "invalid_limit"})
+            return
+        if limit is not None:
+            limit = min(max(1, limit), PAGE_MAX_LIMIT)
+        with_totals = qs.get("totals", [""])[0] in ("1", "true")
+        try:
+            entries = DIR_CACHE.listing(target, sort, descending)
+        except FileNotFoundError:
+            entries = []
+        except NotADirectoryError:
+            json_response(self, 400, {"error": "not_a_directory"})
+            return
+        total = len(entries)
+        end = total if limit is None else offset + limit
+        page = entries[offset:end]
+        result = {
+            "path": rel,
+            "entries": page,
+            "total": total,
+            "next_offset": end if end < total else None,
+        }
+        if with_totals:
+            # Записи из кэша общие для всех запросов — итоги добавляются в копии
+            result["entries"] = page = [dict(e) for e in page]
+            for entry in page:
+                if entry["is_dir"]:
+                    try:
+                        entry["totals"] = DIR_CACHE.totals(os.path.join(target, entry["name"]))
+                    except OSError:
+                        entry["totals"] = None
             try:
-                note_id = int(parsed.path.split("/")[-1])
-            except ValueError:
-                json_response(self, 400, {"error": "invalid_id"})
-                return
-            data = parse_json(self)
+                result["totals"] = DIR_CACHE.totals(target)
+            except FileNotFoundError:
+                result["totals"] = {"size": 0, "files": 0, "dirs": 0}
+        json_response(self, 200, result)
+
+    @ROUTER.route("GET", "/api/blog/search", auth="public")
+    def search_blog(self):
+        self.search_response(self.query, published_only=True)
+
+    @ROUTER.route("GET", "/api/blog", auth="public")
+    def get_blog(self):
+        entry = BLOG_CACHE.get()
+        # Кодировка выбирается один раз: от неё зависят и тело, и ETag, с которым сравнивается If-None-Match
+        coding = choose_encoding(self)
+        etag = encoded_etag(entry["etag"], coding)
+        headers = {
+            "ETag": etag,
+            "Last-Modified": entry["last_modified"],
+            "Cache-Control": f"public, max-age={BLOG_MAX_AGE}",
+            "Vary": "Accept-Encoding",
+        }
+        if not_modified(self, etag, entry["modified_ts"]):
+            self.send_response(304)
+            self.send_header("Access-Control-Allow-Origin", FRONTEND_ORIGIN)
+            self.send_header("Access-Control-Allow-Credentials", "true")
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            return
+        if coding:
+            headers["Content-Encoding"] = coding
+            bytes_response(self, 200, entry[coding], headers)
+        else:
+            # choose_encoding вернул None — bytes_response тоже не станет сжимать
+            bytes_response(self, 200, entry["body"], headers)
+
+    @ROUTER.route("POST", "/api/register", auth="public")
+    def register(self):
+        json_response(self, 403, {"error": "registration_disabled"})
+
+    @ROUTER.route("POST", "/api/login", auth="public")
+    def login(self):
+        data = parse_json(self)
+        email = (data.get("email") or "").strip().lower()
+        password = data.get("password") or ""
+        wait = max(
+            LOGIN_IP_LIMITER.retry_after(self.client_address[0]),
+            LOGIN_ACCOUNT_LIMITER.retry_after(email, consume=False),
+        )
+        if wait:
+            json_response(self, 429, {"error": "too_many_attempts"}, {"Retry-After": str(math.ceil(wait))})
+            return
+        conn = get_conn()
+        row = conn.execute(
+            "SELECT id, password_hash FROM users WHERE email = ?",
+            (email,),
+        ).fetchone()
+        try:
+            valid = bool(row) and verify_password(password, row[1])
+        except HasherBusy:
+            conn.close()
+            json_response(self, 503, {"error": "server_busy"}, {"Retry-After": "1"})
+            return
+        if not valid:
+            conn.close()
+            LOGIN_ACCOUNT_LIMITER.retry_after(email)
+            json_response(self, 401, {"error": "invalid_credentials"})
+            return
+        if password_needs_rehash(row[1]):
+            try:
+                conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (hash_password(password), row[0]))
+            except HasherBusy:
+                # Не критично: пересчитаем при следующем входе
+                pass
+        token = base64.urlsafe_b64encode(secrets.token_bytes(32)).decode()
+        expires = int(time.time()) + 7 * 24 * 3600
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (token, user_id, expires_at, created_at) VALUES (?, ?, ?, ?)",
+            (token, row[0], expires, int(time.time())),
+        )
+        trimmed = trim_user_sessions(conn, row[0])
+        conn.commit()
+        conn.close()
+        if trimmed:
+            SESSION_CACHE.invalidate_user(row[0])
+        json_response(self, 200, {"ok": True}, {"Set-Cookie": session_cookie(token)})
+
+    @ROUTER.route("POST", "/api/logout", auth="public")
+    def logout(self):
+        token = get_session_token(self)
+        if token:
             conn = get_conn()
-            row = conn.execute(
-                "SELECT id, title, content_md, published FROM notes WHERE id = ? AND user_id = ?",
-                (note_id, session[1]),
-            ).fetchone()
-            if not row:
-                conn.close()
-                json_response(self, 404, {"error": "not_found"})
-                return
-            title = (data.get("title", row["title"]) or "").strip()
-            content = data.get("content")
-            if content is None:
-                content = row["content_md"]
-            published = row["published"]
-            if "published" in data:
-                published = 1 if data.get("published") else 0
-            if not title:
-                conn.close()
-                json_response(self, 400, {"error": "title_required"})
-                return
+            conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
+            conn.commit()
+            conn.close()
+            SESSION_CACHE.invalidate_token(token)
+        json_response(self, 200, {"ok": True}, {"Set-Cookie": session_cookie("", max_age=0)})
+
+    @ROUTER.route("POST", "/api/admin/users", events=("users",))
+    def create_user(self):
+        data = parse_json(self)
+        nickname = (data.get("nickname") or "").strip()
+        email = (data.get("email") or "").strip().lower()
+        password = data.get("password") or ""
+        make_admin = 1 if data.get("is_admin") else 0
+        if not email or not password or not nickname:
+            json_response(self, 400, {"error": "nickname_email_and_password_required"})
+            return
+        try:
+            password_hash = hash_password(password)
+        except HasherBusy:
+            json_response(self, 503, {"error": "server_busy"}, {"Retry-After": "1"})
+            return
+        conn = get_conn()
+        try:
             conn.execute(
-                "UPDATE notes SET title = ?, content_md = ?, published = ?, updated_at = ? WHERE id = ?",
-                (title, content, published, int(time.time()), note_id),
+                "INSERT INTO users (nickname, email, password_hash, is_admin, created_at) VALUES (?, ?, ?, ?, ?)",
+                (nickname, email, password_hash, make_admin, int(time.time())),
             )
             conn.commit()
+        except sqlite3.IntegrityError:
             conn.close()
-            json_response(self, 200, {"ok": True})
+            json_response(self, 409, {"error": "email_exists"})
             return
+        conn.close()
+        json_response(self, 201, {"ok": True})
 
-        if parsed.path.startswith("/api/passwords/"):
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
+    @ROUTER.route("POST", "/api/files/uploads", events=("files",))
+    def start_chunked_upload(self):
+        data = parse_json(self)
+        name = os.path.basename((data.get("name") or "").replace("\\", "/"))
+        size = data.get("size")
+        if not name:
+            json_response(self, 400, {"error": "name_required"})
+            return
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            json_response(self, 400, {"error": "invalid_size"})
+            return
+        if size > UPLOAD_MAX_BYTES:
+            json_response(self, 413, {"error": "file_too_large", "max_bytes": UPLOAD_MAX_BYTES})
+            return
+        try:
+            if link_known_blob(data.get("path") or "", name, (data.get("sha256") or "").lower(), size):
+                # Такое содержимое уже есть в хранилище — загружать нечего
+                json_response(self, 201, {"ok": True, "deduplicated": True, "name": name, "size": size})
                 return
+            meta = create_chunked_upload(data.get("path") or "", name, size, data.get("sha256"))
+        except UploadError as exc:
+            json_response(self, exc.status, {"error": exc.code})
+            return
+        except OSError:
+            json_response(self, 500, {"error": "write_failed"})
+            return
+        json_response(self, 201, {**upload_status(meta), "chunk_bytes": UPLOAD_CHUNK_BYTES})
+
+    @ROUTER.route("POST", "/api/files/uploads/<upload_id>/complete", events=("files",))
+    def finish_chunked_upload(self, upload_id: str):
+        data = parse_json(self)
+        try:
+            status = complete_chunked_upload(upload_id, data.get("sha256"))
+        except UploadError as exc:
+            json_response(self, exc.status, {"error": exc.code})
+            return
+        except OSError:
+            json_response(self, 500, {"error": "write_failed"})
+            return
+        json_response(self, 201, {"ok": True, "name": status["name"], "size": status["size"]})
+
+    @ROUTER.route("POST", "/api/files/upload/stream", events=("files",), body="stream")
+    def upload_stream(self):
+        self.stream_upload(parse_qs(self.query))
+
+    @ROUTER.route("POST", "/api/files/upload", events=("files",), body="legacy_upload")
+    def upload_base64(self):
+        data = parse_json(self, LEGACY_UPLOAD_MAX_BYTES)
+        rel_path = data.get("path") or ""
+        name = data.get("name") or ""
+        content_b64 = data.get("content_base64") or ""
+        if not name or not content_b64:
+            json_response(self, 400, {"error": "name_and_content_required"})
+            return
+        try:
+            resolve_path(rel_path)
+            content = base64.b64decode(content_b64.encode())
+            # Через временный файл: запись на месте испортила бы общий блоб при FILES_DEDUP
+            tmp_path, digest = copy_to_staging(lambda out: out.write(content))
             try:
-                item_id = int(parsed.path.split("/")[-1])
-            except ValueError:
-                json_response(self, 400, {"error": "invalid_id"})
-                return
-            data = parse_json(self)
-            conn = get_conn()
+                place_upload(tmp_path, rel_path, name, digest)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+            json_response(self, 201, {"ok": True})
+        except UploadError as exc:
+            json_response(self, exc.status, {"error": exc.code})
+        except ValueError:
+            json_response(self, 400, {"error": "invalid_path"})
+        except Exception:
+            json_response(self, 500, {"error": "write_failed"})
+
+    @ROUTER.route("POST", "/api/files/folder", events=("files",))
+    def create_folder(self):
+        data = parse_json(self)
+        rel_path = data.get("path") or ""
+        name = (data.get("name") or "").strip()
+        if not name:
+            json_response(self, 400, {"error": "name_required"})
+            return
+        try:
+            target = resolve_path(os.path.join(rel_path, name))
+            os.makedirs(target, exist_ok=True)
+            DIR_CACHE.invalidate(target)
+            json_response(self, 201, {"ok": True})
+        except ValueError:
+            json_response(self, 400, {"error": "invalid_path"})
+        except Exception:
+            json_response(self, 500, {"error": "mkdir_failed"})
+
+    @ROUTER.route("POST", "/api/batch", events=("notes", "passwords"), body="batch")
+    def batch(self):
+        data = parse_json(self, BATCH_MAX_BYTES)
+        operations = data.get("operations") if isinstance(data, dict) else None
+        if not isinstance(operations, list) or not operations:
+            json_response(self, 400, {"error": "operations_required"})
+            return
+        if len(operations) > BATCH_MAX_OPERATIONS:
+            json_response(self, 413, {"error": "too_many_operations"})
+            return
+        self.batch_response(operations, bool(data.get("atomic")))
+
+    @ROUTER.route("POST", "/api/notes/import", events=("notes",), body="import")
+    def import_notes(self):
+        self.import_response("note")
+
+    @ROUTER.route("POST", "/api/passwords/import", events=("passwords",), body="import")
+    def import_passwords(self):
+        self.import_response("password")
+
+    def import_response(self, kind: str):
+        raw = read_request_body(self, IMPORT_MAX_BYTES)
+        content_type = (self.headers.get("Content-Type") or "").split(";", 1)[0].strip().lower()
+        operations = parse_import(raw, content_type, kind)
+        if not operations:
+            json_response(self, 400, {"error": "nothing_to_import"})
+            return
+        atomic = parse_qs(self.query).get("atomic", ["0"])[0] == "1"
+        self.batch_response(operations, atomic)
+
+    def batch_response(self, operations: list, atomic: bool):
+        conn = get_conn()
+        try:
+            results, applied = apply_batch(conn, self.session[1], operations, atomic)
+        finally:
+            conn.close()
+        if applied:
+            BLOG_CACHE.invalidate()
+        failed = sum(1 for result in results if result["status"] >= 400)
+        payload = {"results": results, "applied": applied, "failed": failed}
+        if atomic and failed:
+            json_response(self, 422, {"error": "batch_failed", **payload})
+            return
+        json_response(self, 200, payload)
+
+    @ROUTER.route("POST", "/api/notes", events=("notes",))
+    def create_note(self):
+        title, content, published = note_values(parse_json(self))
+        now = int(time.time())
+        conn = get_conn()
+        conn.execute(
+            "INSERT INTO notes (user_id, title, content_md, published, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.session[1], title, content, published, now, now),
+        )
+        conn.commit()
+        conn.close()
+        BLOG_CACHE.invalidate()
+        json_response(self, 201, {"ok": True})
+
+    @ROUTER.route("POST", "/api/passwords", events=("passwords",))
+    def create_password(self):
+        values = password_values(parse_json(self))
+        now = int(time.time())
+        conn = get_conn()
+        conn.execute(
+            "INSERT INTO password_items (user_id, title, login_enc, password_enc, url_enc, notes_enc, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.session[1], *values, now, now),
+        )
+        conn.commit()
+        conn.close()
+        json_response(self, 201, {"ok": True})
+
+    @ROUTER.route("PUT", "/api/files/uploads/<upload_id>", body="stream")
+    def put_upload_chunk(self, upload_id: str):
+        self.upload_chunk(upload_id, parse_qs(self.query))
+
+    @ROUTER.route("PUT", "/api/me", auth="user", events=("profile",))
+    def update_me(self):
+        data = parse_json(self)
+        full_name = (data.get("full_name") or "").strip()
+        phone = (data.get("phone") or "").strip()
+        password_manager_url = clean_url(data.get("password_manager_url"))
+        conn = get_conn()
+        conn.execute(
+            "UPDATE users SET full_name = ?, phone = ?, password_manager_url = ? WHERE id = ?",
+            (
+                encrypt_field(full_name) if full_name else None,
+                encrypt_field(phone) if phone else None,
+                encrypt_field(password_manager_url) if password_manager_url else None,
+                self.session[1],
+            ),
+        )
+        conn.commit()
+        conn.close()
+        SESSION_CACHE.invalidate_user(self.session[1])
+        json_response(self, 200, {"ok": True})
+
+    @ROUTER.route("PUT", "/api/notes/<int:note_id>", events=("notes",))
+    def update_note(self, note_id: int):
+        data = parse_json(self)
+        self.save_note(note_id, data, requested_version(self, data), None)
+
+    def save_note(self, note_id: int, data: dict, base_version, ops):
+        """Общая часть PUT и PATCH: проверка версии, запись и история.
+
+        ops — правки текста от base_version (PATCH); None — новый текст целиком в data (PUT).
+        """
+        conn = get_conn()
+        try:
             row = conn.execute(
-                "SELECT id, title, login_enc, password_enc, url_enc, notes_enc FROM password_items WHERE id = ? AND user_id = ?",
-                (item_id, session[1]),
+                "SELECT id, title, content_md, published, seq FROM notes WHERE id = ? AND user_id = ?",
+                (note_id, self.session[1]),
             ).fetchone()
             if not row:
-                conn.close()
                 json_response(self, 404, {"error": "not_found"})
                 return
-            title = (data.get("title") or row["title"]).strip()
-            login_val = data.get("login")
-            password_val = data.get("password")
-            url_val = data.get("url")
-            notes_val = data.get("notes")
-            conn.execute(
-                "UPDATE password_items SET title = ?, login_enc = ?, password_enc = ?, url_enc = ?, notes_enc = ?, updated_at = ? WHERE id = ?",
-                (
-                    title,
-                    simple_encrypt(login_val) if login_val is not None else row["login_enc"],
-                    simple_encrypt(password_val) if password_val is not None else row["password_enc"],
-                    simple_encrypt(clean_url(url_val)) if url_val is not None else row["url_enc"],
-                    simple_encrypt(notes_val) if notes_val is not None else row["notes_enc"],
-                    int(time.time()),
-                    item_id,
-                ),
+            if base_version is not None and base_version != row["seq"]:
+                json_response(self, 409, {"error": "version_conflict", "version": row["seq"]})
+                return
+            fields = {key: data[key] for key in ("title", "published") if key in data}
+            if ops is None:
+                fields["content"] = data.get("content")
+            else:
+                ops = parse_text_ops(ops, len(row["content_md"]))
+                fields["content"] = apply_text_ops(row["content_md"], ops)
+            title, content, published = note_values(fields, row)
+            if (title, content, published) == (row["title"], row["content_md"], row["published"]):
+                json_response(self, 200, {"ok": True, "version": row["seq"]}, {"ETag": f'"{row["seq"]}"'})
+                return
+            if ops is None:
+                ops = diff_text_ops(row["content_md"], content)
+            # seq в условии: параллельная запись между SELECT и UPDATE даст конфликт, а не потерю правки
+            cursor = conn.execute(
+                "UPDATE notes SET title = ?, content_md = ?, published = ?, updated_at = ? WHERE id = ? AND seq = ?",
+                (title, content, published, int(time.time()), note_id, row["seq"]),
             )
+            if cursor.rowcount == 0:
+                conn.rollback()
+                current = conn.execute("SELECT seq FROM notes WHERE id = ?", (note_id,)).fetchone()
+                json_response(self, 409, {"error": "version_conflict", "version": current and current["seq"]})
+                return
+            version = conn.execute("SELECT seq FROM notes WHERE id = ?", (note_id,)).fetchone()["seq"]
+            save_note_revision(conn, note_id, row["seq"], row["content_md"], version, content, ops)
             conn.commit()
+        finally:
             conn.close()
+        BLOG_CACHE.invalidate()
+        json_response(self, 200, {"ok": True, "version": version}, {"ETag": f'"{version}"'})
+
+    @ROUTER.route("PUT", "/api/passwords/<int:item_id>", events=("passwords",))
+    def update_password(self, item_id: int):
+        data = parse_json(self)
+        conn = get_conn()
+        row = conn.execute(
+            "SELECT id, title, login_enc, password_enc, url_enc, notes_enc FROM password_items WHERE id = ? AND user_id = ?",
+            (item_id, self.session[1]),
+        ).fetchone()
+        if not row:
+            conn.close()
+            json_response(self, 404, {"error": "not_found"})
+            return
+        conn.execute(
+            "UPDATE password_items SET title = ?, login_enc = ?, password_enc = ?, url_enc = ?, notes_enc = ?, updated_at = ? WHERE id = ?",
+            (*password_values(data, row), int(time.time()), item_id),
+        )
+        conn.commit()
+        conn.close()
+        json_response(self, 200, {"ok": True})
+
+    @ROUTER.route("PATCH", "/api/notes/<int:note_id>", events=("notes",))
+    def patch_note(self, note_id: int):
+        data = parse_json(self)
+        base_version = requested_version(self, data)
+        if base_version is None:
+            json_response(self, 428, {"error": "version_required"})
+            return
+        self.save_note(note_id, data, base_version, data.get("ops", []))
+
+    @ROUTER.route("DELETE", "/api/files/uploads/<upload_id>")
+    def abort_chunked_upload(self, upload_id: str):
+        try:
+            with locked_upload_meta(upload_id) as (session_dir, _):
+                remove_upload_session(session_dir)
+        except UploadError as exc:
+            json_response(self, exc.status, {"error": exc.code})
+            return
+        json_response(self, 200, {"ok": True})
+
+    @ROUTER.route("DELETE", "/api/notes/<int:note_id>", events=("notes",))
+    def delete_note(self, note_id: int):
+        conn = get_conn()
+        conn.execute(
+            "DELETE FROM notes WHERE id = ? AND user_id = ?",
+            (note_id, self.session[1]),
+        )
+        conn.commit()
+        conn.close()
+        BLOG_CACHE.invalidate()
+        json_response(self, 200, {"ok": True})
+
+    @ROUTER.route("DELETE", "/api/passwords/<int:item_id>", events=("passwords",))
+    def delete_password(self, item_id: int):
+        conn = get_conn()
+        conn.execute(
+            "DELETE FROM password_items WHERE id = ? AND user_id = ?",
+            (item_id, self.session[1]),
+        )
+        conn.commit()
+        conn.close()
+        json_response(self, 200, {"ok": True})
+
+    @ROUTER.route("DELETE", "/api/files", events=("files",))
+    def delete_file(self):
+        qs = parse_qs(self.query)
+        rel = qs.get("path", [""])[0]
+        try:
+            target = resolve_path(rel)
+            if os.path.isdir(target):
+                if os.listdir(target):
+                    json_response(self, 400, {"error": "dir_not_empty"})
+                    return
+                os.rmdir(target)
+            elif os.path.isfile(target):
+                os.remove(target)
+                release_file(target)
+            DIR_CACHE.invalidate(target)
             json_response(self, 200, {"ok": True})
+        except ValueError:
+            json_response(self, 400, {"error": "invalid_path"})
+        except FileNotFoundError:
+            json_response(self, 404, {"error": "not_found"})
+        except Exception:
+            json_response(self, 500, {"error": "delete_failed"})
+
+    def search_response(self, query: str, user_id: int = None, published_only: bool = False):
+        try:
+            params = parse_search_query(query)
+        except ValueError as exc:
+            json_response(self, 400, {"error": str(exc)})
+            return
+        conn = get_conn()
+        if not search_available(conn):
+            conn.close()
+            json_response(self, 501, {"error": "search_unavailable"})
             return
-        json_response(self, 404, {"error": "not_found"})
+        rows, next_offset = search_notes(conn, params, user_id=user_id, published_only=published_only)
+        conn.close()
+        results = []
+        for row in rows:
+            result = {
+                "id": row["id"],
+                "title": row["title"],
+                "snippet": row["snippet"],
+                "updated_at": row["updated_at"],
+            }
+            if published_only:
+                result["author_email"] = row["author_email"]
+            else:
+                result["published"] = row["published"]
+            results.append(result)
+        json_response(self, 200, {"results": results, "next_offset": next_offset})
 
-    def do_DELETE(self):  # noqa: N802
-        parsed = urlparse(self.path)
-        if parsed.path.startswith("/api/notes/"):
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
+    def stream_upload(self, qs: dict):
+        """Тело запроса (сырые байты или multipart/form-data) копируется на диск частями.
+
+        Параметры в query: path — папка, name — имя файла (для multipart берётся из части).
+        """
+        # Тело читается здесь же; при ошибке посередине соединение закрывается
+        self.body_pending = 0
+        rel_path = qs.get("path", [""])[0]
+        length_header = self.headers.get("Content-Length")
+        if length_header is None:
+            # Тело без длины (chunked) не дочитать безопасно — соединение закрываем
+            self.close_connection = True
+            json_response(self, 411, {"error": "length_required"})
+            return
+        try:
+            length = int(length_header)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            json_response(self, 400, {"error": "invalid_content_length"})
+            return
+        if length > UPLOAD_MAX_BYTES:
+            self.close_connection = True
+            json_response(self, 413, {"error": "file_too_large", "max_bytes": UPLOAD_MAX_BYTES})
+            return
+        upload_id = self.headers.get("X-Upload-Id") or secrets.token_hex(8)
+        content_type = self.headers.get_content_type()
+        reader = BodyReader(self.rfile, length, upload_id)
+        UPLOAD_PROGRESS.start(upload_id, length)
+        tmp_path = None
+        try:
             try:
-                note_id = int(parsed.path.split("/")[-1])
+                resolve_path(rel_path)
             except ValueError:
-                json_response(self, 400, {"error": "invalid_id"})
+                raise UploadError(400, "invalid_path")
+            if content_type == "multipart/form-data":
+                boundary = self.headers.get_param("boundary")
+                if not boundary:
+                    raise UploadError(400, "invalid_multipart")
+                name, tmp_path, digest = receive_multipart(reader, boundary)
+            else:
+                name = qs.get("name", [""])[0]
+                if not name:
+                    raise UploadError(400, "name_required")
+                tmp_path, digest = receive_raw(reader)
+            size = os.path.getsize(tmp_path)
+            place_upload(tmp_path, rel_path, name, digest)
+            tmp_path = None
+        except UploadError as exc:
+            UPLOAD_PROGRESS.finish(upload_id, exc.code)
+            if reader.remaining:
+                self.close_connection = True
+            json_response(self, exc.status, {"error": exc.code, "upload_id": upload_id})
+            return
+        except OSError:
+            UPLOAD_PROGRESS.finish(upload_id, "write_failed")
+            self.close_connection = True
+            json_response(self, 500, {"error": "write_failed", "upload_id": upload_id})
+            return
+        finally:
+            if tmp_path is not None:
+                os.unlink(tmp_path)
+        UPLOAD_PROGRESS.finish(upload_id)
+        json_response(self, 201, {"ok": True, "upload_id": upload_id, "name": name, "size": size})
+
+    def send_file(self, rel_path: str):
+        """Отдаёт файл через sendfile: тело не проходит через Python, поддерживаются Range и 304."""
+        try:
+            target = resolve_path(rel_path)
+        except ValueError:
+            json_response(self, 400, {"error": "invalid_path"})
+            return
+        try:
+            f = open(target, "rb")
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            json_response(self, 404, {"error": "not_found"})
+            return
+        with f:
+            info = os.fstat(f.fileno())
+            etag = file_etag(info)
+            modified_ts = int(info.st_mtime)
+            # Общие для 200/206 и 304: без CORS кросс-доменный условный GET не прочитать
+            headers = {
+                "Access-Control-Allow-Origin": FRONTEND_ORIGIN,
+                "Access-Control-Allow-Credentials": "true",
+                "ETag": etag,
+                "Last-Modified": email.utils.formatdate(modified_ts, usegmt=True),
+                "Cache-Control": "private, no-cache",
+                "Accept-Ranges": "bytes",
+            }
+            if not_modified(self, etag, modified_ts):
+                self.send_response(304)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
                 return
-            conn = get_conn()
-            conn.execute(
-                "DELETE FROM notes WHERE id = ? AND user_id = ?",
-                (note_id, session[1]),
+            size = info.st_size
+            start, end = 0, size - 1
+            status = 200
+            range_header = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+            if range_header and (not if_range or if_range.strip() in (etag, headers["Last-Modified"])):
+                try:
+                    requested = parse_range(range_header, size)
+                except ValueError:
+                    json_response(self, 416, {"error": "range_not_satisfiable"}, {"Content-Range": f"bytes */{size}"})
+                    return
+                if requested:
+                    start, end = requested
+                    status = 206
+                    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            name = os.path.basename(target)
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            ascii_name = name.encode("ascii", "replace").decode().replace('"', "_")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header(
+                "Content-Disposition", f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(name)}"
             )
-            conn.commit()
-            conn.close()
-            json_response(self, 200, {"ok": True})
+            self.send_header("X-Content-Type-Options", "nosniff")
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.send_file_body(f, start, end - start + 1)
+
+    def send_file_body(self, f, offset: int, count: int):
+        if count <= 0:
             return
-        if parsed.path.startswith("/api/passwords/"):
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
-                return
+        try:
+            # socket.sendfile сам откатывается на send(), если os.sendfile недоступен
+            self.connection.sendfile(f, offset, count)
+        except OSError:
+            # Клиент оборвал загрузку — дописывать ответ некуда
+            self.close_connection = True
+
+    def upload_chunk(self, upload_id: str, qs: dict):
+        """Кусок возобновляемой загрузки: PUT /api/files/uploads/<id>?offset=N, тело — сырые байты."""
+        self.body_pending = 0
+        try:
+            offset = int(qs.get("offset", [""])[0])
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self.close_connection = True
+            json_response(self, 400, {"error": "invalid_range"})
+            return
+        try:
+            status = write_upload_chunk(upload_id, offset, self.rfile, length, self.headers.get("X-Chunk-Sha256"))
+        except UploadError as exc:
+            # Тело могло остаться недочитанным
+            self.close_connection = True
+            json_response(self, exc.status, {"error": exc.code})
+            return
+        except OSError:
+            self.close_connection = True
+            json_response(self, 500, {"error": "write_failed"})
+            return
+        json_response(self, 200, status)
+
+
+class BufferedAppHandler(AppHandler):
+    """AppHandler для уже разобранного запроса: тело в памяти, ответ копится в буфер.
+
+    Позволяет asyncio-движку вызывать те же do_* без сокета.
+    """
+
+    # Ответ всё равно собирается в памяти, Content-Length проставит frame_response
+    supports_streaming = False
+    keep_alive_limits = False
+
+    def __init__(self, command: str, path: str, version: str, headers, rfile, client_address):
+        # BaseHTTPRequestHandler.__init__ сразу читает сокет, поэтому не вызывается
+        self.command = command
+        self.path = path
+        self.request_version = version
+        self.requestline = f"{command} {path} {version}"
+        self.headers = headers
+        self.rfile = rfile
+        self.wfile = io.BytesIO()
+        self.client_address = client_address
+        self.close_connection = False
+        self.pending_file = None
+        self.pending_events = None
+
+    def request_body_length(self) -> int:
+        # Тело движок уже прочитал целиком или отдал маршруту потоком (AsyncBodyStream)
+        return 0
+
+    def send_file_body(self, f, offset: int, count: int):
+        # Файл не копится в буфере: движок отправит его через loop.sendfile после заголовков
+        self.pending_file = (os.dup(f.fileno()), offset, count)
+
+    def dispatch(self) -> bytes:
+        method = getattr(self, "do_" + self.command, None)
+        if method is None:
+            self.send_error(501, f"Unsupported method ({self.command!r})")
+        else:
+            method()
+        return self.wfile.getvalue()
+
+
+def frame_response(raw: bytes, keep_alive: bool, content_length: int = None) -> bytes:
+    """Проставляет ответу из буфера точный Content-Length и Connection.
+
+    content_length задаётся, когда тело отправляется отдельно (файл через sendfile).
+    """
+    head, _, body = raw.partition(b"\r\n\r\n")
+    lines = head.split(b"\r\n")
+    status = int(lines[0].split(b" ", 2)[1])
+    headers = [line for line in lines[1:] if not line.lower().startswith((b"connection:", b"content-length:"))]
+    if status >= 200 and status not in (204, 304):
+        headers.append(b"Content-Length: %d" % (len(body) if content_length is None else content_length))
+    headers.append(b"Connection: keep-alive" if keep_alive else b"Connection: close")
+    return b"\r\n".join([lines[0]] + headers) + b"\r\n\r\n" + body
+
+
+class BadRequest(Exception):
+    pass
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def body_length(headers):
+    """Длина тела по Content-Length; None — chunked."""
+    encoding = (headers.get("Transfer-Encoding") or "").lower()
+    if encoding and encoding != "identity":
+        if encoding != "chunked":
+            raise BadRequest("unsupported_transfer_encoding")
+        # Оба заголовка сразу — приём подмены запросов через прокси
+        if headers.get("Content-Length") is not None:
+            raise BadRequest("ambiguous_length")
+        return None
+    try:
+        length = int(headers.get("Content-Length") or 0)
+    except ValueError:
+        raise BadRequest("invalid_content_length")
+    if length < 0:
+        raise BadRequest("invalid_content_length")
+    return length
+
+
+async def read_body(reader: asyncio.StreamReader, length, max_bytes: int) -> bytes:
+    """Тело в память; больше max_bytes не читается — BodyTooLarge."""
+    if length is not None:
+        if length > max_bytes:
+            raise BodyTooLarge()
+        return await reader.readexactly(length) if length else b""
+    chunks = []
+    total = 0
+    while True:
+        size_line = await reader.readuntil(b"\r\n")
+        try:
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise BadRequest("invalid_chunk")
+        if size == 0:
+            # Трейлеры не используются, читаем до пустой строки
+            while await reader.readuntil(b"\r\n") != b"\r\n":
+                pass
+            return b"".join(chunks)
+        total += size
+        if total > max_bytes:
+            raise BodyTooLarge()
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+
+class AsyncBodyStream:
+    """rfile маршрутов body="stream": поток пула читает тело из сокета частями, не копя его в памяти."""
+
+    def __init__(self, reader: asyncio.StreamReader, loop, length: int):
+        self.reader = reader
+        self.loop = loop
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if self.remaining <= 0:
+            return b""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self.reader.read(size), ASYNC_IDLE_TIMEOUT), self.loop
+        )
+        try:
+            data = future.result()
+        except (asyncio.TimeoutError, ConnectionError):
+            # Клиент замолчал или оборвал соединение: маршрут увидит неполное тело
+            return b""
+        self.remaining -= len(data)
+        return data
+
+
+def too_large_response() -> bytes:
+    body = json.dumps({"error": "body_too_large"}).encode()
+    head = (
+        "HTTP/1.1 413 Payload Too Large\r\n"
+        "Content-Type: application/json; charset=utf-8\r\n"
+        f"Access-Control-Allow-Origin: {FRONTEND_ORIGIN}\r\n"
+        "Access-Control-Allow-Credentials: true\r\n"
+        "\r\n"
+    )
+    return frame_response(head.encode() + body, keep_alive=False)
+
+
+class AsyncHTTPServer:
+    """Небольшой HTTP/1.1 сервер на asyncio с keep-alive и конвейеризацией.
+
+    Ожидающее соединение стоит одну корутину; обработка маршрута (SQLite, scrypt)
+    уходит в пул потоков, ответы пишутся строго в порядке запросов.
+    """
+
+    def __init__(self, port: int, workers: int):
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="route")
+        self.connections = set()
+        self.idle = set()
+        self.closing = False
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle_connection, "0.0.0.0", self.port, limit=ASYNC_MAX_HEADER_BYTES
+        )
+        return self.server
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        peer = writer.get_extra_info("peername")
+        loop = asyncio.get_running_loop()
+        handled = 0
+        try:
+            while not self.closing:
+                self.idle.add(task)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), ASYNC_IDLE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                finally:
+                    self.idle.discard(task)
+                try:
+                    request_line, _, header_block = head.partition(b"\r\n")
+                    command, path, version = request_line.decode("latin-1").split(" ", 2)
+                    if not version.startswith("HTTP/1."):
+                        raise BadRequest("unsupported_version")
+                    headers = parse_headers(io.BytesIO(header_block))
+                    length = body_length(headers)
+                    # Лимит тела известен до чтения: по маршруту, а не после разбора в обработчике
+                    try:
+                        route, _ = ROUTER.resolve(command, urlparse(path).path)
+                    except ApiError:
+                        route = None
+                    kind = route.body if route is not None else "json"
+                    if kind == "stream":
+                        rfile = AsyncBodyStream(reader, loop, length or 0)
+                    else:
+                        rfile = io.BytesIO(await read_body(reader, length, BODY_LIMITS[kind]))
+                        if length is None:
+                            # Для обработчика chunked-тело уже обычное, с известной длиной
+                            del headers["Transfer-Encoding"]
+                            headers["Content-Length"] = str(len(rfile.getvalue()))
+                except BodyTooLarge:
+                    writer.write(too_large_response())
+                    await writer.drain()
+                    break
+                except (ValueError, BadRequest, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    writer.write(frame_response(b"HTTP/1.1 400 Bad Request\r\n\r\n", keep_alive=False))
+                    await writer.drain()
+                    break
+                connection = (headers.get("Connection") or "").lower()
+                if version == "HTTP/1.0":
+                    keep_alive = connection == "keep-alive"
+                else:
+                    keep_alive = connection != "close"
+                handler = BufferedAppHandler(command, path, version, headers, rfile, peer)
+                raw = await loop.run_in_executor(self.executor, handler.dispatch)
+                handled += 1
+                keep_alive = keep_alive and not handler.close_connection and not self.closing
+                if isinstance(rfile, AsyncBodyStream) and (length is None or rfile.remaining > 0):
+                    # Маршрут не дочитал тело (401, ошибка посередине): следующий запрос не найти
+                    keep_alive = False
+                keep_alive = keep_alive and handled < KEEPALIVE_MAX_REQUESTS
+                if handler.pending_events:
+                    await self.stream_events(writer, raw, handler.pending_events)
+                    break
+                if handler.pending_file:
+                    fd, offset, count = handler.pending_file
+                    with open(fd, "rb") as f:
+                        writer.write(frame_response(raw, keep_alive, count))
+                        await writer.drain()
+                        await loop.sendfile(writer.transport, f, offset, count)
+                else:
+                    writer.write(frame_response(raw, keep_alive))
+                    await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(task)
+            self.idle.discard(task)
+            writer.close()
+
+    async def stream_events(self, writer: asyncio.StreamWriter, head: bytes, subscriber: EventSubscriber):
+        """Поток /api/events на корутине: подписчику не нужен поток пула."""
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        subscriber.wake = lambda: loop.call_soon_threadsafe(ready.set)
+        # Заголовки уже с Connection: close и без Content-Length — frame_response не нужен
+        writer.write(head)
+        deadline = loop.time() + EVENTS_MAX_AGE
+        try:
+            while not self.closing and loop.time() < deadline:
+                ready.clear()
+                events, closed = EVENT_BUS.take(subscriber)
+                if closed:
+                    break
+                if events:
+                    writer.write(b"".join(map(EVENT_BUS.format, events)))
+                await writer.drain()
+                try:
+                    await asyncio.wait_for(ready.wait(), min(EVENTS_HEARTBEAT, max(0.0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    writer.write(b": ping\n\n")
+        finally:
+            EVENT_BUS.unsubscribe(subscriber)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await self.start()
+        await stop.wait()
+        self.closing = True
+        EVENT_BUS.close_all()
+        self.server.close()
+        await self.server.wait_closed()
+        # Простаивающие keep-alive соединения закрываются, текущие запросы дорабатывают
+        for task in list(self.idle):
+            task.cancel()
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=10)
+        self.executor.shutdown(wait=True)
+        DB_POOL.close_all()
+        PASSWORD_HASHER.shutdown()
+
+
+def busy_response() -> bytes:
+    body = json.dumps({"error": "server_busy"}).encode()
+    head = (
+        "HTTP/1.0 503 Service Unavailable\r\n"
+        "Content-Type: application/json; charset=utf-8\r\n"
+        f"Access-Control-Allow-Origin: {FRONTEND_ORIGIN}\r\n"
+        "Access-Control-Allow-Credentials: true\r\n"
+        "Retry-After: 1\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    return head.encode() + body
+
+
+class WorkerPoolHTTPServer(HTTPServer):
+    """HTTPServer с фиксированным пулом потоков и ограниченной очередью.
+
+    Если все потоки заняты и очередь заполнена, соединение сразу получает 503,
+    вместо того чтобы плодить потоки без ограничений.
+    """
+
+    def __init__(self, server_address, handler_class, workers: int, backlog: int, reuse_port: bool = False):
+        self.reuse_port = reuse_port
+        self.jobs = queue.Queue(maxsize=backlog)
+        self.busy_response = busy_response()
+        # Потоки, ждущие следующего запроса keep-alive, спят на этом канале (wait_for_request)
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.waiting = 0
+        self.waiting_lock = threading.Lock()
+        self.closing = False
+        self.request_queue_size = max(backlog, 5)
+        super().__init__(server_address, handler_class)
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        try:
+            self.jobs.put_nowait((request, client_address))
+        except queue.Full:
             try:
-                item_id = int(parsed.path.split("/")[-1])
-            except ValueError:
-                json_response(self, 400, {"error": "invalid_id"})
-                return
-            conn = get_conn()
-            conn.execute(
-                "DELETE FROM password_items WHERE id = ? AND user_id = ?",
-                (item_id, session[1]),
-            )
-            conn.commit()
-            conn.close()
-            json_response(self, 200, {"ok": True})
+                request.sendall(self.busy_response)
+            except OSError:
+                pass
+            self.shutdown_request(request)
             return
-        if parsed.path == "/api/files":
-            session = with_session(self)
-            if not session:
-                json_response(self, 401, {"error": "auth_required"})
-                return
-            if not is_admin(session):
-                json_response(self, 403, {"error": "admin_only"})
+        with self.waiting_lock:
+            if self.waiting:
+                # Один байт — одно освобождённое keep-alive соединение
+                with contextlib.suppress(BlockingIOError):
+                    os.write(self.wakeup_w, b"\0")
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
                 return
-            qs = parse_qs(parsed.query)
-            rel = qs.get("path", [""])[0]
+            request, client_address = job
             try:
-                target = resolve_path(rel)
-                if os.path.isdir(target):
-                    if os.listdir(target):
-                        json_response(self, 400, {"error": "dir_not_empty"})
-                        return
-                    os.rmdir(target)
-                elif os.path.isfile(target):
-                    os.remove(target)
-                json_response(self, 200, {"ok": True})
-            except ValueError:
-                json_response(self, 400, {"error": "invalid_path"})
-            except FileNotFoundError:
-                json_response(self, 404, {"error": "not_found"})
+                self.finish_request(request, client_address)
             except Exception:
-                json_response(self, 500, {"error": "delete_failed"})
-            return
-        json_response(self, 404, {"error": "not_found"})
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        EVENT_BUS.close_all()
+        # Уже принятые запросы дорабатываются до конца
+        # Простаивающие keep-alive соединения закрываются, а не ждут KEEPALIVE_TIMEOUT
+        self.closing = True
+        with contextlib.suppress(BlockingIOError):
+            os.write(self.wakeup_w, b"\0" * len(self.workers))
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+        DB_POOL.close_all()
+        PASSWORD_HASHER.shutdown()
+
+
+def make_server(port: int, mode: str = SERVER_MODE):
+    address = ("0.0.0.0", port)
+    if mode == "single":
+        return HTTPServer(address, AppHandler)
+    if mode == "threaded":
+        return WorkerPoolHTTPServer(address, AppHandler, SERVER_WORKERS, SERVER_BACKLOG)
+    if mode == "prefork":
+        return WorkerPoolHTTPServer(address, AppHandler, SERVER_WORKERS, SERVER_BACKLOG, reuse_port=True)
+    raise ValueError(f"unknown SERVER_MODE: {mode}")
+
+
+def serve_until_signal(server):
+    def stop(signum, frame):
+        # shutdown() ждёт выхода serve_forever, поэтому вызывается из другого потока
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def run_prefork(port: int, processes: int):
+    children = set()
+    stopping = False
+    # HASH_WORKERS рассчитан на всю машину: процессы prefork делят его, а не множат
+    hash_workers = max(1, HASH_WORKERS // processes) if HASH_WORKERS > 0 else 0
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                PASSWORD_HASHER.resize(hash_workers)
+                server = make_server(port, "prefork")
+                start_background_tasks()
+                serve_until_signal(server)
+            except Exception:
+                code = 1
+            os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(processes):
+        spawn()
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            # Упавший воркер заменяется новым
+            time.sleep(0.1)
+            spawn()
 
 
 def run():
     port = int(os.environ.get("PORT", "8000"))
     ensure_db()
-    server = HTTPServer(("0.0.0.0", port), AppHandler)
-    print(f"Backend running on port {port}")
-    server.serve_forever()
+    # Первичный админ хешируется ещё при старте: пул этих процессов не нужен
+    # (и не должен достаться по fork воркерам prefork) — он создастся заново по запросу
+    PASSWORD_HASHER.shutdown()
+    if SERVER_MODE == "asyncio":
+        start_background_tasks()
+        print(f"Backend running on port {port} (asyncio)")
+        asyncio.run(AsyncHTTPServer(port, SERVER_WORKERS).serve())
+        return
+    if SERVER_MODE == "prefork":
+        print(f"Backend running on port {port} ({SERVER_PROCESSES} processes x {SERVER_WORKERS} threads)")
+        run_prefork(port, SERVER_PROCESSES)
+        return
+    server = make_server(port)
+    start_background_tasks()
+    print(f"Backend running on port {port} ({SERVER_MODE})")
+    serve_until_signal(server)
 
 
 if __name__ == "__main__":
-    run()
+    if sys.argv[1:] == ["rebuild-search"]:
+        ensure_db()
+        rebuild_search_index()
+    elif sys.argv[1:] == ["dedup-files"]:
+        ensure_db()
+        files, saved = dedup_existing_files()
+        print(f"Linked {files} files to the blob store, {saved} bytes saved")
+    else:
+        run()
@@ -0,0 +1,423 @@
+"""Замер задержек backend на временной БД.
+
+Запуск: python bench.py [сценарий ...] [--requests N] [--concurrency C]
+                        [--mode single|threaded|prefork|asyncio] [--processes P]
+Без аргументов прогоняет все сценарии. Без --mode сервер поднимается
+в этом же процессе, с --mode — отдельным процессом `app.py`.
+Реальную /data не трогает.
+"""
+import argparse
+import http.client
+import json
+import os
+import select
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+WORKDIR = tempfile.mkdtemp(prefix="bench-")
+os.environ["DB_PATH"] = os.path.join(WORKDIR, "app.db")
+os.environ["FILES_ROOT"] = os.path.join(WORKDIR, "files")
+os.environ.setdefault("APP_SECRET", "bench-secret")
+# Все запросы идут с 127.0.0.1 — лимит входов мешал бы замерам
+os.environ.setdefault("LOGIN_IP_BURST", "0")
+os.environ.setdefault("LOGIN_ACCOUNT_BURST", "0")
+
+import app  # noqa: E402
+
+
+def start_inprocess():
+    app.ensure_db()
+    # Пул потоков, а не single: однопоточный сервер закрывает каждое соединение
+    server = app.WorkerPoolHTTPServer(("127.0.0.1", 0), app.AppHandler, app.SERVER_WORKERS, app.SERVER_BACKLOG)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+
+    return server.server_address[1], stop
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_subprocess(mode: str, processes: int):
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), SERVER_MODE=mode, SERVER_PROCESSES=str(processes))
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            request(port, "GET", "/api/health")
+            break
+        except OSError:
+            time.sleep(0.05)
+
+    def stop():
+        proc.terminate()
+        proc.wait(timeout=10)
+
+    return port, stop
+
+
+def request(port, method, path, body=None, cookie=None, extra_headers=None, raw_body=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    headers = {"Content-Type": "application/json", **(extra_headers or {})}
+    if cookie:
+        headers["Cookie"] = cookie
+    if raw_body is None and body is not None:
+        raw_body = json.dumps(body)
+    conn.request(method, path, body=raw_body, headers=headers)
+    resp = conn.getresponse()
+    data = resp.read()
+    conn.close()
+    return resp, data
+
+
+def login(port):
+    resp, _ = request(
+        port,
+        "POST",
+        "/api/login",
+        {"email": app.DEFAULT_ADMIN_EMAIL, "password": app.DEFAULT_ADMIN_PASSWORD},
+    )
+    return resp.getheader("Set-Cookie").split(";", 1)[0]
+
+
+def client_loop(port, method, path, cookie, count, body=None):
+    samples = []
+    for _ in range(count):
+        t0 = time.perf_counter()
+        request(port, method, path, body, cookie)
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def report(name, samples, total, concurrency):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(
+        f"{name:<24} n={len(samples):<6} c={concurrency:<3} rps={len(samples) / total:8.1f} "
+        f"p50={statistics.median(samples) * 1000:7.3f}ms p99={p99 * 1000:7.3f}ms"
+    )
+
+
+def measure(name, port, method, path, cookie, count, concurrency):
+    started = time.perf_counter()
+    if concurrency == 1:
+        samples = client_loop(port, method, path, cookie, count)
+    else:
+        per_client = max(1, count // concurrency)
+        with ProcessPoolExecutor(concurrency) as pool:
+            futures = [pool.submit(client_loop, port, method, path, cookie, per_client) for _ in range(concurrency)]
+            samples = [s for f in futures for s in f.result()]
+    report(name, samples, time.perf_counter() - started, concurrency)
+
+
+def bench_health(port, cookie, args):
+    measure("GET /api/health", port, "GET", "/api/health", None, args.requests, args.concurrency)
+
+
+def bench_me(port, cookie, args):
+    measure("GET /api/me", port, "GET", "/api/me", cookie, args.requests, args.concurrency)
+
+
+def bench_notes(port, cookie, args):
+    for i in range(50):
+        request(port, "POST", "/api/notes", {"title": f"note {i}", "content": "# bench\n" * 20}, cookie)
+    measure("GET /api/notes", port, "GET", "/api/notes?limit=all", cookie, args.requests, args.concurrency)
+
+
+def bench_login(port, cookie, args):
+    """Входы в --concurrency процессах и параллельно обычные запросы к /api/me."""
+    body = {"email": app.DEFAULT_ADMIN_EMAIL, "password": app.DEFAULT_ADMIN_PASSWORD}
+    per_client = max(1, args.requests // 10 // args.concurrency)
+    started = time.perf_counter()
+    with ProcessPoolExecutor(args.concurrency) as pool:
+        futures = [
+            pool.submit(client_loop, port, "POST", "/api/login", None, per_client, body)
+            for _ in range(args.concurrency)
+        ]
+        measure("GET /api/me +logins", port, "GET", "/api/me", cookie, args.requests, 1)
+        samples = [s for f in futures for s in f.result()]
+    report("POST /api/login", samples, time.perf_counter() - started, args.concurrency)
+
+
+def bench_blog(port, cookie, args):
+    for i in range(100):
+        body = {"title": f"post {i}", "content": "## Раздел\n\nТекст поста с **разметкой**.\n" * 40, "published": True}
+        request(port, "POST", "/api/notes", body, cookie)
+    measure("GET /api/blog", port, "GET", "/api/blog", None, args.requests, args.concurrency)
+
+
+def bench_vault(port, cookie, args):
+    """Список из 10k записей менеджера паролей: расшифровка 4 полей на строку."""
+    now = int(time.time())
+    user_id = app.get_conn().execute("SELECT id FROM users").fetchone()[0]
+    rows = [
+        (
+            user_id,
+            f"site {i}",
+            app.encrypt_field(f"user{i}@example.com"),
+            app.encrypt_field(f"password-{i}-" + "x" * 16),
+            app.encrypt_field(f"https://site{i}.example.com/login"),
+            app.encrypt_field("recovery codes and notes " * 4),
+            now,
+            now,
+        )
+        for i in range(10000)
+    ]
+    conn = app.get_conn()
+    conn.executemany(
+        "INSERT INTO password_items (user_id, title, login_enc, password_enc, url_enc, notes_enc, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+    measure("GET /api/passwords 10k", port, "GET", "/api/passwords?limit=all", cookie, max(1, args.requests // 100), 1)
+    values = [value for row in rows for value in row[2:6]]
+    started = time.perf_counter()
+    app.decrypt_fields(values)
+    print(f"{'decrypt_fields 40k':<24} {(time.perf_counter() - started) * 1000:.1f}ms")
+
+
+def bench_compression(port, cookie, args):
+    """Байты на проводе и CPU на сжатие для списков с Markdown."""
+    for i in range(50):
+        body = {"title": f"doc {i}", "content": f"# Документ {i}\n\n" + "Абзац текста заметки, *курсив*.\n" * 60, "published": True}
+        request(port, "POST", "/api/notes", body, cookie)
+        request(port, "POST", "/api/passwords", {"title": f"site {i}", "password": f"pw-{i}", "url": f"site{i}.example"}, cookie)
+    count = max(1, args.requests // 10)
+    for path in ("/api/notes", "/api/blog", "/api/passwords"):
+        _, raw = request(port, "GET", path, cookie=cookie, extra_headers={"Accept-Encoding": "identity"})
+        for coding in ("identity", "gzip", "deflate"):
+            headers = {"Accept-Encoding": coding}
+            _, data = request(port, "GET", path, cookie=cookie, extra_headers=headers)
+            cpu = 0.0
+            if coding != "identity":
+                started = time.process_time()
+                for _ in range(20):
+                    app.compress_body(raw, coding)
+                cpu = (time.process_time() - started) / 20 * 1000
+            samples = []
+            for _ in range(count):
+                t0 = time.perf_counter()
+                request(port, "GET", path, cookie=cookie, extra_headers=headers)
+                samples.append(time.perf_counter() - t0)
+            print(
+                f"{path + ' ' + coding:<28} bytes={len(data):<8} cpu={cpu:6.3f}ms "
+                f"p50={statistics.median(samples) * 1000:7.3f}ms"
+            )
+
+
+def bench_batch(port, cookie, args):
+    """N отдельных POST против одного /api/batch и импорта CSV."""
+    count = min(args.requests, app.BATCH_MAX_OPERATIONS)
+    started = time.perf_counter()
+    for i in range(count):
+        request(port, "POST", "/api/passwords", {"title": f"one {i}", "password": "pw"}, cookie)
+    single = time.perf_counter() - started
+    operations = [
+        {"op": "create", "type": "password", "data": {"title": f"batch {i}", "password": "pw"}} for i in range(count)
+    ]
+    started = time.perf_counter()
+    _, data = request(port, "POST", "/api/batch", {"operations": operations}, cookie)
+    batch = time.perf_counter() - started
+    applied = json.loads(data)["applied"]
+    rows = "".join(f"csv {i},https://site{i}.example,user{i},pw{i},\n" for i in range(count))
+    started = time.perf_counter()
+    request(
+        port,
+        "POST",
+        "/api/passwords/import",
+        cookie=cookie,
+        raw_body=("name,url,username,password,note\n" + rows).encode(),
+        extra_headers={"Content-Type": "text/csv"},
+    )
+    imported = time.perf_counter() - started
+    print(
+        f"{'create x' + str(count):<24} single={single * 1000:8.1f}ms batch={batch * 1000:7.1f}ms "
+        f"(applied {applied}) csv import={imported * 1000:7.1f}ms"
+    )
+
+
+def bench_sync(port, cookie, args):
+    """Полный список против /api/sync?since= после правки одной заметки."""
+    operations = [
+        {"op": "create", "type": "note", "data": {"title": f"sync {i}", "content": "Note text. " * 40}}
+        for i in range(app.BATCH_MAX_OPERATIONS)
+    ]
+    _, data = request(port, "POST", "/api/batch", {"operations": operations}, cookie)
+    note_id = json.loads(data)["results"][0]["id"]
+    _, data = request(port, "GET", "/api/sync", cookie=cookie)
+    seq = json.loads(data)["seq"]
+    request(port, "PUT", f"/api/notes/{note_id}", {"title": "changed"}, cookie)
+    count = max(1, args.requests // 10)
+    for name, path in (("full /api/notes", "/api/notes?limit=all"), ("delta /api/sync", f"/api/sync?since={seq}")):
+        headers = {"Accept-Encoding": "identity"}
+        _, body = request(port, "GET", path, cookie=cookie, extra_headers=headers)
+        samples = []
+        for _ in range(count):
+            t0 = time.perf_counter()
+            request(port, "GET", path, cookie=cookie, extra_headers=headers)
+            samples.append(time.perf_counter() - t0)
+        print(f"{name:<24} bytes={len(body):<8} p50={statistics.median(samples) * 1000:7.3f}ms")
+
+
+def bench_autosave(port, cookie, args):
+    """Автосохранение длинной заметки: PUT всего текста против PATCH с правкой."""
+    content = "".join(f"Строка {i} длинного документа с *Markdown*.\n" for i in range(5000))
+    request(port, "POST", "/api/notes", {"title": "autosave", "content": content}, cookie)
+    _, data = request(port, "GET", "/api/notes?fields=id&limit=1", cookie=cookie)
+    note_id = json.loads(data)["notes"][0]["id"]
+    count = max(1, args.requests // 10)
+    conn = app.get_conn()
+    for name in ("PUT", "PATCH"):
+        revisions_before = conn.execute("SELECT COALESCE(SUM(length(data)), 0) FROM note_revisions").fetchone()[0]
+        _, data = request(port, "GET", f"/api/notes/{note_id}", cookie=cookie)
+        version = json.loads(data)["note"]["version"]
+        samples = []
+        sent = 0
+        for i in range(count):
+            if name == "PUT":
+                content = content + f"правка {i}\n"
+                body = {"title": "autosave", "content": content, "base_version": version}
+            else:
+                body = {"ops": [{"pos": len(content), "insert": f"правка {i}\n"}], "base_version": version}
+                content = content + f"правка {i}\n"
+            raw = json.dumps(body)
+            sent += len(raw)
+            t0 = time.perf_counter()
+            _, data = request(port, name, f"/api/notes/{note_id}", cookie=cookie, raw_body=raw)
+            samples.append(time.perf_counter() - t0)
+            version = json.loads(data)["version"]
+        stored = conn.execute("SELECT COALESCE(SUM(length(data)), 0) FROM note_revisions").fetchone()[0] - revisions_before
+        print(
+            f"{name + ' 5000-line note':<24} req={sent // count:<7} history={stored // count:<7} "
+            f"p50={statistics.median(samples) * 1000:7.3f}ms"
+        )
+    conn.close()
+
+
+def bench_events(port, cookie, args):
+    """K открытых вкладок: один круг опроса /api/sync против рассылки события в K потоков."""
+    # В потоковых режимах каждый поток событий держит поток пула
+    streams = 200 if args.mode == "asyncio" else app.EVENTS_MAX_THREADS
+    sockets = []
+    for _ in range(streams):
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.sendall(f"GET /api/events HTTP/1.1\r\nHost: bench\r\nCookie: {cookie}\r\n\r\n".encode())
+        sockets.append(sock)
+    time.sleep(0.5)
+    for sock in sockets:
+        sock.setblocking(False)
+        try:
+            while sock.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+    started = time.perf_counter()
+    for _ in range(streams):
+        request(port, "GET", "/api/sync?since=0&limit=1", cookie=cookie)
+    poll = time.perf_counter() - started
+    started = time.perf_counter()
+    request(port, "POST", "/api/notes", {"title": "event"}, cookie)
+    waiting = set(sockets)
+    deadline = time.time() + 10
+    while waiting and time.time() < deadline:
+        readable, _, _ = select.select(list(waiting), [], [], 1)
+        for sock in readable:
+            if b"event: notes" in sock.recv(65536):
+                waiting.discard(sock)
+    fanout = time.perf_counter() - started
+    for sock in sockets:
+        sock.close()
+    print(
+        f"{'events x' + str(streams):<24} poll round={poll * 1000:8.1f}ms "
+        f"fan-out={fanout * 1000:7.1f}ms missed={len(waiting)}"
+    )
+
+
+def keepalive_loop(port, path, cookie, count):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    headers = {"Cookie": cookie} if cookie else {}
+    samples = []
+    for _ in range(count):
+        t0 = time.perf_counter()
+        conn.request("GET", path, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        samples.append(time.perf_counter() - t0)
+        if resp.will_close:
+            conn.close()
+    conn.close()
+    return samples
+
+
+def bench_keepalive(port, cookie, args):
+    """Новое соединение на каждый запрос против одного постоянного."""
+    for path, auth in (("/api/health", None), ("/api/me", cookie)):
+        measure(f"GET {path} close", port, "GET", path, auth, args.requests, 1)
+        started = time.perf_counter()
+        samples = keepalive_loop(port, path, auth, args.requests)
+        report(f"GET {path} keep-alive", samples, time.perf_counter() - started, 1)
+
+
+SCENARIOS = {
+    "health": bench_health,
+    "me": bench_me,
+    "notes": bench_notes,
+    "login": bench_login,
+    "vault": bench_vault,
+    "blog": bench_blog,
+    "compression": bench_compression,
+    "keepalive": bench_keepalive,
+    "batch": bench_batch,
+    "sync": bench_sync,
+    "autosave": bench_autosave,
+    "events": bench_events,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", metavar="scenario", help=", ".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=1, help="число клиентских процессов")
+    parser.add_argument("--mode", choices=["single", "threaded", "prefork", "asyncio"])
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="воркеры для prefork")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(sorted(unknown))}")
+    if args.mode:
+        port, stop = start_subprocess(args.mode, args.processes)
+    else:
+        port, stop = start_inprocess()
+    try:
+        cookie = login(port)
+        for name in args.scenarios or SCENARIOS:
+            SCENARIOS[name](port, cookie, args)
+    finally:
+        stop()
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -43,6 +43,9 @@ const state = {
   selectedNoteId: null,
   passwords: [],
   editingPasswordId: null,
+  // Последний seq из /api/sync: дальше запрашиваются только изменения
+  syncSeq: 0,
+  events: null,
 };
 
 function setStatus(text) {
@@ -52,8 +55,8 @@ function setStatus(text) {
 async function api(path, options = {}) {
   const resp = await fetch(`${API_BASE}${path}`, {
     credentials: 'include',
-    headers: { 'Content-Type': 'application/json' },
     ...options,
+    headers: { 'Content-Type': 'application/json', ...options.headers },
   });
   if (resp.status === 204) return null;
   const data = await resp.json().catch(() => ({}));
@@ -61,6 +64,63 @@ async function api(path, options = {}) {
   return data;
 }
 
+function mergeChanges(items, changed, deleted) {
+  const byId = new Map(items.map((item) => [item.id, item]));
+  deleted.forEach((id) => byId.delete(id));
+  changed.forEach((item) => byId.set(item.id, item));
+  return [...byId.values()].sort((a, b) => b.updated_at - a.updated_at || b.id - a.id);
+}
+
+async function syncData() {
+  let more = true;
+  while (more) {
+    const data = await api(`/api/sync?since=${state.syncSeq}`);
+    if (data.reset) {
+      state.notes = [];
+      state.passwords = [];
+    }
+    state.notes = mergeChanges(state.notes, data.notes, data.deleted.notes);
+    state.passwords = mergeChanges(state.passwords, data.passwords, data.deleted.passwords);
+    state.syncSeq = data.seq;
+    more = data.more;
+  }
+}
+
+// Сервер сообщает об изменениях через SSE, данные забираются дельтой /api/sync
+let eventsTimer = null;
+
+function refreshFromEvents() {
+  clearTimeout(eventsTimer);
+  eventsTimer = setTimeout(async () => {
+    try {
+      await syncData();
+      renderNotes();
+      renderPasswords();
+    } catch (e) {
+      // следующее событие или перезагрузка страницы повторят синхронизацию
+    }
+  }, 300);
+}
+
+function subscribeEvents() {
+  if (state.events || !window.EventSource) return;
+  const source = new EventSource(`${API_BASE}/api/events`, { withCredentials: true });
+  source.addEventListener('notes', refreshFromEvents);
+  source.addEventListener('passwords', refreshFromEvents);
+  // Пропущенные события не восстановить: полная синхронизация
+  source.addEventListener('reset', () => {
+    state.syncSeq = 0;
+    refreshFromEvents();
+  });
+  state.events = source;
+}
+
+function unsubscribeEvents() {
+  if (state.events) state.events.close();
+  state.events = null;
+  clearTimeout(eventsTimer);
+}
+
 function formatDate(ts) {
   return new Date(ts * 1000).toLocaleString('ru-RU');
 }
@@ -89,7 +149,9 @@ async function loadProfile() {
       return;
     }
     showDashboard(data.user);
-    await Promise.all([loadNotes(), loadPasswords()]);
+    await loadNotes();
+    renderPasswords();
+    subscribeEvents();
   } catch (e) {
     state.user = null;
     hideDashboard();
@@ -149,8 +211,7 @@ function loadNoteIntoForm(note) {
 
 async function loadNotes() {
   try {
-    const data = await api('/api/notes');
-    state.notes = data.notes;
+    await syncData();
     renderNotes();
   } catch (e) {
     kbList.innerHTML = '<p class="empty">Не удалось загрузить статьи</p>';
@@ -167,9 +228,55 @@ function resetNoteForm() {
   detailBody.textContent = 'Впишите текст и сохраните, чтобы увидеть полную версию';
 }
 
+// Правка одним диапазоном; позиции в символах (code points), как на сервере
+function textPatch(base, text) {
+  const a = Array.from(base);
+  const b = Array.from(text);
+  let start = 0;
+  while (start < a.length && start < b.length && a[start] === b[start]) start += 1;
+  let end = 0;
+  while (end < a.length - start && end < b.length - start && a[a.length - 1 - end] === b[b.length - 1 - end]) end += 1;
+  if (start === a.length && start === b.length) return [];
+  return [{ pos: start, delete: a.length - start - end, insert: b.slice(start, b.length - end).join('') }];
+}
+
+let autosaveTimer = null;
+let autosaving = false;
+
+async function autosaveNote() {
+  const note = state.notes.find((n) => n.id === state.selectedNoteId);
+  if (!note) return;
+  if (autosaving) {
+    autosaveTimer = setTimeout(autosaveNote, 500);
+    return;
+  }
+  const content = noteContent.value;
+  const ops = textPatch(note.content_md, content);
+  if (!ops.length) return;
+  autosaving = true;
+  try {
+    const data = await api(`/api/notes/${note.id}`, {
+      method: 'PATCH',
+      headers: { 'If-Match': `"${note.version}"` },
+      body: JSON.stringify({ ops }),
+    });
+    note.content_md = content;
+    note.version = data.version;
+    setStatus('Черновик сохранён');
+  } catch (err) {
+    setStatus(err.message === 'version_conflict' ? 'Статья изменена в другом окне — обновите список' : 'Не удалось автосохранить');
+  } finally {
+    autosaving = false;
+  }
+}
+
 noteForm.addEventListener('input', (e) => {
   if (e.target.name === 'content') {
     previewEl.textContent = e.target.value;
+    if (state.selectedNoteId) {
+      clearTimeout(autosaveTimer);
+      autosaveTimer = setTimeout(autosaveNote, 1500);
+    }
   }
 });
 
@@ -180,8 +287,11 @@ noteForm.addEventListener('submit', async (e) => {
     content: noteContent.value,
     published: notePublish.checked,
   };
+  clearTimeout(autosaveTimer);
   try {
     if (state.selectedNoteId) {
+      const note = state.notes.find((n) => n.id === state.selectedNoteId);
+      if (note) body.base_version = note.version;
       await api(`/api/notes/${state.selectedNoteId}`, { method: 'PUT', body: JSON.stringify(body) });
     } else {
       await api('/api/notes', { method: 'POST', body: JSON.stringify(body) });
@@ -189,7 +299,7 @@ noteForm.addEventListener('submit', async (e) => {
     resetNoteForm();
     await loadNotes();
   } catch (err) {
-    alert('Не удалось сохранить статью');
+    alert(err.message === 'version_conflict' ? 'Статья изменена в другом окне — обновите список' : 'Не удалось сохранить статью');
   }
 });
 
@@ -221,6 +331,10 @@ authForm.addEventListener('submit', async (e) => {
 logoutBtn.addEventListener('click', async () => {
   await api('/api/logout', { method: 'POST' });
   state.user = null;
+  state.notes = [];
+  state.passwords = [];
+  state.syncSeq = 0;
+  unsubscribeEvents();
   hideDashboard();
 });
 
@@ -329,8 +443,7 @@ refreshPasswordsBtn.addEventListener('click', () => loadPasswords());
 
 async function loadPasswords() {
   try {
-    const data = await api('/api/passwords');
-    state.passwords = data.items;
+    await syncData();
     renderPasswords();
   } catch (e) {
     passwordList.innerHTML = '<p class="empty">Не удалось загрузить пароли</p>';